@@ -0,0 +1,54 @@
+"""Add product_price_history with current prices as the first interval
+
+Revision ID: 1a9e5c3f7b40
+Revises: f0c83d5a7e29
+Create Date: 2026-10-17 18:31:52.117640
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1a9e5c3f7b40'
+down_revision: Union[str, None] = 'f0c83d5a7e29'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'product_price_history',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('valid_from', sa.DateTime(), nullable=False),
+        sa.Column('valid_to', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['product_id'], ['products.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_product_price_history_product_from', 'product_price_history', ['product_id', 'valid_from'], unique=False)
+    op.create_index(
+        'uq_product_price_history_open',
+        'product_price_history',
+        ['product_id'],
+        unique=True,
+        postgresql_where=sa.text('valid_to IS NULL')
+    )
+    # Прошлые цены неизвестны: текущая считается действующей с начала истории
+    op.execute(
+        "INSERT INTO product_price_history (product_id, user_id, price, valid_from) "
+        "SELECT id, user_id, price, TIMESTAMP '1970-01-01' FROM products"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('uq_product_price_history_open', table_name='product_price_history')
+    op.drop_index('ix_product_price_history_product_from', table_name='product_price_history')
+    op.drop_table('product_price_history')
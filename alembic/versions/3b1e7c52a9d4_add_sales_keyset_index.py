@@ -0,0 +1,28 @@
+"""Add composite index for keyset pagination of sales
+
+Revision ID: 3b1e7c52a9d4
+Revises: 0d4f39a6d78d
+Create Date: 2026-10-17 10:12:40.118532
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b1e7c52a9d4'
+down_revision: Union[str, None] = '0d4f39a6d78d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_sales_user_date_id', 'sales', ['user_id', 'date_sold', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sales_user_date_id', table_name='sales')
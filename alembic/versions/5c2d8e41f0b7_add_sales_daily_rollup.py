@@ -0,0 +1,40 @@
+"""Add sales_daily_rollup table
+
+Revision ID: 5c2d8e41f0b7
+Revises: 3b1e7c52a9d4
+Create Date: 2026-10-17 11:03:18.524907
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c2d8e41f0b7'
+down_revision: Union[str, None] = '3b1e7c52a9d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('sales_daily_rollup',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.Column('revenue', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'product_id', 'day')
+    )
+    op.create_index('ix_sales_daily_rollup_user_day', 'sales_daily_rollup', ['user_id', 'day'], unique=False)
+    # Заполнение витрины: python -m backend.rollup
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sales_daily_rollup_user_day', table_name='sales_daily_rollup')
+    op.drop_table('sales_daily_rollup')
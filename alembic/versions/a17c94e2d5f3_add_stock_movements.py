@@ -0,0 +1,49 @@
+"""Add stock_movements ledger
+
+Revision ID: a17c94e2d5f3
+Revises: 8e4a0f3d6b21
+Create Date: 2026-10-17 12:40:55.903126
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a17c94e2d5f3'
+down_revision: Union[str, None] = '8e4a0f3d6b21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('stock_movements',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('balance_after', sa.Integer(), nullable=False),
+    sa.Column('sale_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['product_id'], ['products.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_stock_movements_user_product_created', 'stock_movements', ['user_id', 'product_id', 'created_at', 'id'], unique=False)
+    op.create_index(op.f('ix_stock_movements_sale_id'), 'stock_movements', ['sale_id'], unique=False)
+    # Начальный снимок: текущие остатки становятся первой записью журнала
+    op.execute(
+        "INSERT INTO stock_movements (user_id, product_id, kind, quantity, balance_after, created_at) "
+        "SELECT user_id, product_id, 'snapshot', quantity, quantity, now() AT TIME ZONE 'utc' FROM stock"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_stock_movements_sale_id'), table_name='stock_movements')
+    op.drop_index('ix_stock_movements_user_product_created', table_name='stock_movements')
+    op.drop_table('stock_movements')
@@ -0,0 +1,38 @@
+"""Make stock.minimum_quantity required and add low-stock partial index
+
+Revision ID: b52f6d0e8c14
+Revises: a17c94e2d5f3
+Create Date: 2026-10-17 13:21:37.045812
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b52f6d0e8c14'
+down_revision: Union[str, None] = 'a17c94e2d5f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("UPDATE stock SET minimum_quantity = 10 WHERE minimum_quantity IS NULL")
+    op.alter_column('stock', 'minimum_quantity',
+               existing_type=sa.INTEGER(),
+               nullable=False,
+               server_default='10')
+    op.create_index('ix_stock_low', 'stock', ['user_id', 'id'], unique=False,
+                    postgresql_where=sa.text('quantity < minimum_quantity'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_stock_low', table_name='stock')
+    op.alter_column('stock', 'minimum_quantity',
+               existing_type=sa.INTEGER(),
+               nullable=True,
+               server_default=None)
@@ -0,0 +1,39 @@
+"""Merge duplicate stock rows and add unique (product_id, user_id)
+
+Revision ID: c3e8a1b7f92d
+Revises: b52f6d0e8c14
+Create Date: 2026-10-17 14:02:11.387245
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3e8a1b7f92d'
+down_revision: Union[str, None] = 'b52f6d0e8c14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Дубликаты сливаются в строку с наименьшим id, количество суммируется
+    op.execute(
+        "UPDATE stock SET quantity = d.total "
+        "FROM (SELECT min(id) AS keep_id, sum(quantity) AS total FROM stock "
+        "GROUP BY product_id, user_id HAVING count(*) > 1) AS d "
+        "WHERE stock.id = d.keep_id"
+    )
+    op.execute(
+        "DELETE FROM stock USING stock AS keep "
+        "WHERE stock.product_id = keep.product_id AND stock.user_id = keep.user_id AND stock.id > keep.id"
+    )
+    op.create_unique_constraint('uq_stock_product_user', 'stock', ['product_id', 'user_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('uq_stock_product_user', 'stock', type_='unique')
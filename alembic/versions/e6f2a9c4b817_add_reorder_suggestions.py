@@ -0,0 +1,43 @@
+"""Add reorder_suggestions table
+
+Revision ID: e6f2a9c4b817
+Revises: d41b7c9e2a68
+Create Date: 2026-10-17 16:05:37.204816
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6f2a9c4b817'
+down_revision: Union[str, None] = 'd41b7c9e2a68'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'reorder_suggestions',
+        sa.Column('stock_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('avg_daily_demand', sa.Float(), nullable=False),
+        sa.Column('demand_std', sa.Float(), nullable=False),
+        sa.Column('days_of_cover', sa.Float(), nullable=True),
+        sa.Column('reorder_point', sa.Integer(), nullable=False),
+        sa.Column('order_quantity', sa.Integer(), nullable=False),
+        sa.Column('computed_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['stock_id'], ['stock.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('stock_id')
+    )
+    op.create_index(op.f('ix_reorder_suggestions_user_id'), 'reorder_suggestions', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_reorder_suggestions_user_id'), table_name='reorder_suggestions')
+    op.drop_table('reorder_suggestions')
@@ -0,0 +1,37 @@
+"""Add product name search indexes
+
+Revision ID: f0c83d5a7e29
+Revises: e6f2a9c4b817
+Create Date: 2026-10-17 17:12:09.843551
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f0c83d5a7e29'
+down_revision: Union[str, None] = 'e6f2a9c4b817'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index('ix_products_user_lower_name', 'products', ['user_id', sa.text('lower(name) COLLATE "C"')], unique=False)
+    op.create_index(
+        'ix_products_name_trgm',
+        'products',
+        ['name'],
+        postgresql_using='gin',
+        postgresql_ops={'name': 'gin_trgm_ops'}
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_products_name_trgm', table_name='products')
+    op.drop_index('ix_products_user_lower_name', table_name='products')
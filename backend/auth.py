@@ -5,8 +5,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from backend.database import get_db
 from backend.models import User
+from backend.throttle import login_throttle
 from dependencies import get_current_user, manager
-from dependencies import hash_password, verify_password
+from dependencies import hash_password_async, verify_and_update_password
 from datetime import timedelta
 
 router = APIRouter()
@@ -29,7 +30,7 @@ async def register(
     result = await db.execute(select(User).filter(User.email == email))
     if result.scalar_one_or_none():
         raise HTTPException(status_code=400, detail="Email already exists")
-    new_user = User(username=username, email=email, hashed_password=hash_password(password))
+    new_user = User(username=username, email=email, hashed_password=await hash_password_async(password))
     db.add(new_user)
     await db.commit()
     return RedirectResponse(url="/login", status_code=303)
@@ -40,16 +41,27 @@ async def show_login_form(request: Request):
 
 @router.post("/login", summary="Вход в систему")
 async def login(
+    request: Request,
     username: str = Form(...),
     password: str = Form(...),
     db: AsyncSession = Depends(get_db)
 ):
+    retry_after = await login_throttle.check(request.client.host if request.client else "unknown", username)
+    if retry_after is not None:
+        raise HTTPException(status_code=429, detail="Too many login attempts", headers={"Retry-After": str(retry_after)})
     result = await db.execute(select(User).filter(User.username == username))
     user = result.scalar_one_or_none()
-    if not user or not verify_password(password, user.hashed_password):
-        response = RedirectResponse(url="/login?error=1", status_code=303)
-        return response
-    access_token = manager.create_access_token(data={"sub": user.username}, expires=timedelta(hours=1))
+    if not user:
+        return RedirectResponse(url="/login?error=1", status_code=303)
+    verified, new_hash = await verify_and_update_password(password, user.hashed_password)
+    if not verified:
+        return RedirectResponse(url="/login?error=1", status_code=303)
+    if new_hash:
+        # Пароль открыт только сейчас: переводим хэш на текущую стоимость
+        user.hashed_password = new_hash
+        await db.commit()
+    # uid и email в токене используются при AUTH_TRUST_TOKEN_CLAIMS
+    access_token = manager.create_access_token(data={"sub": user.username, "uid": user.id, "email": user.email}, expires=timedelta(hours=1))
     response = RedirectResponse(url="/", status_code=303)
     manager.set_cookie(response, access_token)
     return response
@@ -0,0 +1,160 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from config import REDIS_URL, REPORT_CACHE_BACKEND, REPORT_CACHE_TTL, REPORT_CACHE_SIZE, logger
+
+
+class LRUCache:
+    # Ограниченный по размеру LRU-кэш с TTL и счётчиками попаданий/промахов
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+class LocalVersions:
+    # Версии данных внутри процесса: запись в одном воркере не видна другим,
+    # поэтому годится только для запуска в один процесс
+
+    def __init__(self):
+        self.versions = {}
+
+    async def get(self, user_id: int) -> int:
+        return self.versions.get(user_id, 0)
+
+    async def bump(self, user_id: int):
+        self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+
+class RedisVersions:
+    # Общие для всех воркеров версии через INCR
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+
+    async def get(self, user_id: int) -> int:
+        version = await self.client.get(f"report:version:{user_id}")
+        return int(version) if version else 0
+
+    async def bump(self, user_id: int):
+        await self.client.incr(f"report:version:{user_id}")
+
+
+class MemoryReportCache:
+    # Значения отчётов внутри процесса; версии - в переданном хранилище
+
+    def __init__(self, maxsize: int, ttl: float, versions):
+        self.cache = LRUCache(maxsize, ttl)
+        self.versions = versions
+
+    async def get_version(self, user_id: int) -> int:
+        return await self.versions.get(user_id)
+
+    async def bump_version(self, user_id: int):
+        await self.versions.bump(user_id)
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def set(self, key, value):
+        self.cache.set(key, value)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class RedisReportCache:
+    # Общий для всех воркеров кэш: версии через INCR, значения с EXPIRE
+
+    def __init__(self, url: str, ttl: int):
+        self.versions = RedisVersions(url)
+        self.client = self.versions.client
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get_version(self, user_id: int) -> int:
+        return await self.versions.get(user_id)
+
+    async def bump_version(self, user_id: int):
+        await self.versions.bump(user_id)
+
+    async def get(self, key):
+        value = await self.client.get(f"report:{key}")
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value)
+
+    async def set(self, key, value):
+        await self.client.set(f"report:{key}", pickle.dumps(value), ex=self.ttl)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+def create_report_cache():
+    if REPORT_CACHE_BACKEND == "redis":
+        return RedisReportCache(REDIS_URL, REPORT_CACHE_TTL)
+    if REPORT_CACHE_BACKEND == "local":
+        return MemoryReportCache(REPORT_CACHE_SIZE, REPORT_CACHE_TTL, RedisVersions(REDIS_URL))
+    return MemoryReportCache(REPORT_CACHE_SIZE, REPORT_CACHE_TTL, LocalVersions())
+
+
+report_cache = create_report_cache()
+
+
+async def bump_data_version(user_id: int):
+    # Вызывается после коммита записи: закэшированные отчёты со старой версией
+    # больше не читаются. Ошибка кэша не должна ломать саму запись
+    try:
+        await report_cache.bump_version(user_id)
+    except Exception as e:
+        logger.error(f"Не удалось сбросить кэш отчёта для user_id={user_id}: {str(e)}")
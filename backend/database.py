@@ -1,15 +1,98 @@
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 import os
+import random
+import time
 from dotenv import load_dotenv
 from sqlalchemy.ext.declarative import declarative_base
+from config import (
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+    DB_STATEMENT_CACHE_SIZE, DB_ECHO, DB_ECHO_SAMPLE_RATE, logger
+)
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_async_engine(DATABASE_URL, echo=True)
+
+
+class PoolStats:
+    # Сколько раз и как долго запросы ждали соединение из пула
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float, timed_out: bool = False):
+        if timed_out:
+            self.timeouts += 1
+        else:
+            self.checkouts += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def snapshot(self, pool):
+        return {
+            "pool_size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "max_overflow": DB_MAX_OVERFLOW,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+            "wait_max_ms": self.wait_max * 1000
+        }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    # Ожидание свободного соединения происходит в _do_get, его и замеряем
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.record(time.perf_counter() - started)
+        return connection
+
+
+# Размеры пула задаются на воркер: pool_size + max_overflow, умноженное на
+# число воркеров uvicorn, не должно превышать max_connections Postgres
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=DB_ECHO,
+    poolclass=InstrumentedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={"statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+)
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+if not DB_ECHO and DB_ECHO_SAMPLE_RATE > 0:
+    # Вместо полного echo логируется только доля запросов
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def log_sampled_statement(conn, cursor, statement, parameters, context, executemany):
+        if random.random() < DB_ECHO_SAMPLE_RATE:
+            logger.info(f"SQL: {statement}")
+
 async def get_db():
     async with AsyncSessionLocal() as db:
-        yield db
\ No newline at end of file
+        yield db
+
+def get_session_factory():
+    # Для StreamingResponse: сессия из get_db закрывается до отправки тела ответа,
+    # поэтому генератор открывает собственную сессию через эту фабрику
+    return AsyncSessionLocal
@@ -0,0 +1,116 @@
+import asyncio
+import json
+from config import REDIS_URL, STOCK_EVENTS_BACKEND, STOCK_EVENTS_QUEUE_SIZE, logger
+
+
+def stock_change(stock_id: int, quantity: int = None, minimum_quantity: int = None, product_name: str = None, deleted: bool = False):
+    # Изменённая строка страницы /stocks: только те поля, что известны после записи
+    change = {"id": stock_id}
+    if deleted:
+        change["deleted"] = True
+        return change
+    if quantity is not None:
+        change["quantity"] = quantity
+    if minimum_quantity is not None:
+        change["minimum_quantity"] = minimum_quantity
+    if product_name is not None:
+        change["product_name"] = product_name
+    return change
+
+
+class LocalStockEvents:
+    # Pub/sub внутри процесса: у каждого подписчика своя ограниченная очередь.
+    # None в очереди - сигнал клиенту перечитать страницу целиком
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+
+    def dispatch(self, user_id: int, changes):
+        for queue in self.subscribers.get(user_id, ()):
+            try:
+                queue.put_nowait(changes)
+            except asyncio.QueueFull:
+                # Медленный клиент не тормозит запись: его очередь сбрасывается
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+                self.dropped += 1
+
+    async def publish(self, user_id: int, changes):
+        self.published += 1
+        self.dispatch(user_id, changes)
+
+    def stats(self):
+        return {
+            "subscribers": sum(len(queues) for queues in self.subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped
+        }
+
+
+class RedisStockEvents(LocalStockEvents):
+    # Публикация через Redis, чтобы изменения дошли до клиентов всех воркеров;
+    # каждый воркер держит одну подписку stock:* и раздаёт сообщения локально
+
+    def __init__(self, url: str, queue_size: int):
+        super().__init__(queue_size)
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.listener = None
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self.listen())
+        return super().subscribe(user_id)
+
+    async def listen(self):
+        pubsub = self.client.pubsub()
+        await pubsub.psubscribe("stock:*")
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                user_id = int(message["channel"].decode().split(":", 1)[1])
+                self.dispatch(user_id, json.loads(message["data"]))
+        except Exception as e:
+            logger.error(f"Подписка на изменения остатков прервана: {str(e)}")
+        finally:
+            await pubsub.close()
+
+    async def publish(self, user_id: int, changes):
+        self.published += 1
+        await self.client.publish(f"stock:{user_id}", json.dumps(changes))
+
+
+def create_stock_events():
+    if STOCK_EVENTS_BACKEND == "redis":
+        return RedisStockEvents(REDIS_URL, STOCK_EVENTS_QUEUE_SIZE)
+    return LocalStockEvents(STOCK_EVENTS_QUEUE_SIZE)
+
+
+stock_events = create_stock_events()
+
+
+async def publish_stock_changes(user_id: int, changes):
+    # Вызывается после коммита; как и сброс кэша, не должен ломать саму запись
+    if not changes:
+        return
+    try:
+        await stock_events.publish(user_id, changes)
+    except Exception as e:
+        logger.error(f"Не удалось опубликовать изменения остатков для user_id={user_id}: {str(e)}")
@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import datetime
+import numpy as np
+from sqlalchemy import select, delete, func, cast, literal_column, Date
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import NullPool
+from backend.database import DATABASE_URL
+from backend.models import Stock, SalesDailyRollup, ReorderSuggestion, User
+from config import (
+    FORECAST_HISTORY_DAYS, FORECAST_WINDOW_DAYS, FORECAST_LEAD_TIME_DAYS,
+    FORECAST_REVIEW_DAYS, FORECAST_SERVICE_Z, logger
+)
+
+# Матрица обрабатывается блоками строк, чтобы промежуточные массивы
+# (накопленные суммы, ошибки прогноза) не удваивали пиковую память
+FORECAST_CHUNK_ROWS = 8192
+# Строка чтения - один товар со всей его историей
+FORECAST_READ_PARTITION = 1000
+FORECAST_WRITE_BATCH = 5000
+FORECAST_USERS_PER_CHUNK = 100
+
+def moving_average(series: np.ndarray, window: int) -> np.ndarray:
+    # Скользящее среднее по дням для всех товаров сразу через накопленные суммы;
+    # столбец i - среднее за дни [i, i + window)
+    cumsum = np.cumsum(series, axis=1, dtype=np.float64)
+    result = cumsum[:, window - 1:].copy()
+    result[:, 1:] -= cumsum[:, :-window]
+    result /= window
+    return result
+
+def compute_suggestions(
+    series: np.ndarray,
+    on_hand: np.ndarray,
+    window: int = FORECAST_WINDOW_DAYS,
+    lead_time_days: int = FORECAST_LEAD_TIME_DAYS,
+    review_days: int = FORECAST_REVIEW_DAYS,
+    service_z: float = FORECAST_SERVICE_Z
+) -> dict:
+    # series - продажи в штуках, товары x дни (последний столбец - вчера);
+    # on_hand - доступный остаток по тем же строкам
+    products, days = series.shape
+    window = min(window, days)
+    demand = np.empty(products, dtype=np.float64)
+    sigma = np.empty(products, dtype=np.float64)
+    for start in range(0, products, FORECAST_CHUNK_ROWS):
+        block = series[start:start + FORECAST_CHUNK_ROWS]
+        stop = start + block.shape[0]
+        # Спрос - скользящее среднее на последний день. Разброс - не дисперсия
+        # продаж, а среднеквадратичная ошибка прогноза "завтра = среднее за окно"
+        # по всей истории: она учитывает и шум, и тренд
+        averages = moving_average(block, window)
+        demand[start:stop] = averages[:, -1]
+        if days > window:
+            errors = block[:, window:] - averages[:, :-1]
+            sigma[start:stop] = np.sqrt(np.mean(np.square(errors), axis=1))
+        else:
+            sigma[start:stop] = block.std(axis=1)
+    on_hand = np.asarray(on_hand, dtype=np.float64)
+    safety_stock = service_z * sigma * np.sqrt(lead_time_days)
+    reorder_point = np.ceil(demand * lead_time_days + safety_stock)
+    order_quantity = np.maximum(np.ceil(demand * (lead_time_days + review_days) + safety_stock - on_hand), 0)
+    days_of_cover = np.full(products, np.nan)
+    np.divide(on_hand, demand, out=days_of_cover, where=demand > 0)
+    return {
+        "avg_daily_demand": demand,
+        "demand_std": sigma,
+        "days_of_cover": days_of_cover,
+        "reorder_point": reorder_point.astype(np.int64),
+        "order_quantity": order_quantity.astype(np.int64)
+    }
+
+def fill_series(series: np.ndarray, product_ids: np.ndarray, rows):
+    # rows - (product_id, смещения дней, штуки) по одному товару на строку;
+    # смещения и штуки приходят из базы упакованными int4 (big-endian), так что
+    # Python проходит только по товарам, а дни разбирает и раскладывает numpy
+    if not rows:
+        return
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    lengths = np.fromiter((len(row[1]) // 4 for row in rows), dtype=np.int64, count=len(rows))
+    offsets = np.frombuffer(b"".join(row[1] for row in rows), dtype=">i4")
+    units = np.frombuffer(b"".join(row[2] for row in rows), dtype=">i4")
+    index = np.searchsorted(product_ids, ids)
+    found = index < len(product_ids)
+    found[found] = product_ids[index[found]] == ids[found]
+    keep = np.repeat(found, lengths)
+    series[np.repeat(index, lengths)[keep], offsets[keep]] = units[keep]
+
+async def load_series(db: AsyncSession, user_id: int, start: datetime.date, days: int):
+    # Строки матрицы - позиции склада по возрастанию product_id, столбцы - дни
+    # от start; данные берутся из витрины sales_daily_rollup. База сворачивает
+    # дни товара в одну строку, поэтому строк результата столько же, сколько
+    # товаров, а не товаро-дней
+    stocks = (await db.execute(
+        select(Stock.id, Stock.product_id, Stock.quantity - Stock.reserved)
+        .filter(Stock.user_id == user_id)
+        .order_by(Stock.product_id)
+    )).all()
+    stock_ids = np.array([row[0] for row in stocks], dtype=np.int64)
+    product_ids = np.array([row[1] for row in stocks], dtype=np.int64)
+    on_hand = np.array([row[2] for row in stocks], dtype=np.int64)
+    series = np.zeros((len(stocks), days), dtype=np.float32)
+    if not stocks:
+        return stock_ids, series, on_hand
+    # Оба агрегата получают строки группы в одном и том же порядке
+    packed = literal_column("''::bytea")
+    result = await db.stream(
+        select(
+            SalesDailyRollup.product_id,
+            func.string_agg(func.int4send(SalesDailyRollup.day - cast(start, Date)), packed),
+            func.string_agg(func.int4send(SalesDailyRollup.units), packed)
+        )
+        .filter(
+            SalesDailyRollup.user_id == user_id,
+            SalesDailyRollup.day >= start,
+            SalesDailyRollup.day < start + datetime.timedelta(days=days)
+        )
+        .group_by(SalesDailyRollup.product_id)
+        .execution_options(yield_per=FORECAST_READ_PARTITION)
+    )
+    async for rows in result.partitions(FORECAST_READ_PARTITION):
+        fill_series(series, product_ids, rows)
+    return stock_ids, series, on_hand
+
+async def write_suggestions(db: AsyncSession, user_id: int, stock_ids: np.ndarray, suggestions: dict, computed_at: datetime.datetime):
+    columns = {name: values.tolist() for name, values in suggestions.items()}
+    columns["days_of_cover"] = [None if value != value else value for value in columns["days_of_cover"]]
+    ids = stock_ids.tolist()
+    stmt = insert(ReorderSuggestion)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ReorderSuggestion.stock_id],
+        set_={name: stmt.excluded[name] for name in list(columns) + ["computed_at"]}
+    )
+    for start in range(0, len(ids), FORECAST_WRITE_BATCH):
+        batch = [
+            {"stock_id": ids[i], "user_id": user_id, "computed_at": computed_at, **{name: values[i] for name, values in columns.items()}}
+            for i in range(start, min(start + FORECAST_WRITE_BATCH, len(ids)))
+        ]
+        await db.execute(stmt, batch)
+    # Рекомендации по позициям, которых больше нет на складе
+    await db.execute(
+        delete(ReorderSuggestion)
+        .where(ReorderSuggestion.user_id == user_id, ReorderSuggestion.computed_at < computed_at)
+        .execution_options(synchronize_session=False)
+    )
+
+async def forecast_user(db: AsyncSession, user_id: int, today: datetime.date, history_days: int = FORECAST_HISTORY_DAYS) -> int:
+    computed_at = datetime.datetime.utcnow()
+    stock_ids, series, on_hand = await load_series(db, user_id, today - datetime.timedelta(days=history_days), history_days)
+    if len(stock_ids):
+        await write_suggestions(db, user_id, stock_ids, compute_suggestions(series, on_hand), computed_at)
+    return len(stock_ids)
+
+async def run_forecast(history_days: int = FORECAST_HISTORY_DAYS, chunk_size: int = FORECAST_USERS_PER_CHUNK):
+    # Запускается и из Celery, поэтому движок без пула создаётся на время вызова;
+    # каждый пользователь - отдельная транзакция
+    engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
+    today = datetime.datetime.utcnow().date()
+    total = 0
+    try:
+        last_user_id = 0
+        while True:
+            async with AsyncSession(engine) as db:
+                user_ids = (await db.execute(
+                    select(User.id).filter(User.id > last_user_id).order_by(User.id).limit(chunk_size)
+                )).scalars().all()
+            if not user_ids:
+                break
+            for user_id in user_ids:
+                async with AsyncSession(engine) as db:
+                    total += await forecast_user(db, user_id, today, history_days)
+                    await db.commit()
+            last_user_id = user_ids[-1]
+    finally:
+        await engine.dispose()
+    logger.info(f"Рекомендации по дозаказу пересчитаны для {total} позиций")
+    return total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пересчёт точек и объёмов дозаказа по истории продаж")
+    parser.add_argument("--history-days", type=int, default=FORECAST_HISTORY_DAYS)
+    asyncio.run(run_forecast(parser.parse_args().history_days))
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import datetime
+from sqlalchemy import select, insert, update, delete, and_
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import NullPool
+from backend.database import DATABASE_URL
+from backend.models import StockMovement
+from config import STOCK_LEDGER_RETENTION_DAYS, logger
+
+RECEIPT = "receipt"
+SALE = "sale"
+ADJUSTMENT = "adjustment"
+REVERSAL = "reversal"
+SNAPSHOT = "snapshot"
+
+def movement(user_id: int, product_id: int, kind: str, quantity: int, balance_after: int, sale_id: int = None, created_at: datetime.datetime = None):
+    return {
+        "user_id": user_id,
+        "product_id": product_id,
+        "kind": kind,
+        "quantity": quantity,
+        "balance_after": balance_after,
+        "sale_id": sale_id,
+        "created_at": created_at or datetime.datetime.utcnow()
+    }
+
+async def record_movements(db: AsyncSession, movements):
+    # Журнал только дописывается; Stock.quantity остаётся снимком текущего
+    # остатка, а balance_after каждой записи - остатком сразу после неё
+    if movements:
+        await db.execute(insert(StockMovement), list(movements))
+
+async def stock_at(db: AsyncSession, user_id: int, product_id: int, at: datetime.datetime) -> int:
+    # Одна проба индекса (user_id, product_id, created_at, id)
+    result = await db.execute(
+        select(StockMovement.balance_after)
+        .filter(StockMovement.user_id == user_id, StockMovement.product_id == product_id, StockMovement.created_at <= at)
+        .order_by(StockMovement.created_at.desc(), StockMovement.id.desc())
+        .limit(1)
+    )
+    return result.scalar() or 0
+
+async def movements_between(db: AsyncSession, user_id: int, product_id: int, start: datetime.datetime, end: datetime.datetime, limit: int):
+    result = await db.execute(
+        select(StockMovement)
+        .filter(
+            StockMovement.user_id == user_id,
+            StockMovement.product_id == product_id,
+            StockMovement.created_at >= start,
+            StockMovement.created_at < end
+        )
+        .order_by(StockMovement.created_at, StockMovement.id)
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+async def compact_movements(db: AsyncSession, before: datetime.datetime):
+    # Всё, что старше before, сворачивается в одну запись snapshot на товар с
+    # остатком на тот момент: остаток на любую более позднюю дату не меняется.
+    # Последние записи выбираются подзапросом в самой базе: список id в Python
+    # упёрся бы в лимит параметров запроса на большой истории
+    latest = (
+        select(StockMovement.id)
+        .filter(StockMovement.created_at < before)
+        .distinct(StockMovement.user_id, StockMovement.product_id)
+        .order_by(StockMovement.user_id, StockMovement.product_id, StockMovement.created_at.desc(), StockMovement.id.desc())
+    )
+    await db.execute(
+        update(StockMovement)
+        .where(StockMovement.id.in_(latest))
+        .values(kind=SNAPSHOT, quantity=StockMovement.balance_after, sale_id=None)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(
+        delete(StockMovement)
+        .where(and_(StockMovement.created_at < before, StockMovement.id.notin_(latest)))
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+async def compact(retention_days: int = STOCK_LEDGER_RETENTION_DAYS):
+    # Запускается и из Celery, где у каждой задачи свой event loop, поэтому
+    # движок без пула создаётся на время вызова
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+    engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
+    try:
+        async with AsyncSession(engine) as db:
+            removed = await compact_movements(db, before)
+            await db.commit()
+    finally:
+        await engine.dispose()
+    logger.info(f"Журнал движений свёрнут до {before:%Y-%m-%d}: удалено {removed} записей")
+    return removed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Свёртка старых записей журнала stock_movements в снимки")
+    parser.add_argument("--retention-days", type=int, default=STOCK_LEDGER_RETENTION_DAYS)
+    asyncio.run(compact(parser.parse_args().retention_days))
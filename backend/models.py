@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Date, UniqueConstraint, Index, text
 from sqlalchemy.orm import relationship
 from backend.database import Base
 
@@ -71,12 +71,41 @@ class Product(Base):
     agreement = relationship("Agreement", back_populates="products")
     user = relationship("User")
 
-    __table_args__ = (UniqueConstraint("name", "user_id", name="uq_product_name_user"),)
+    # Поиск по названию: btree по lower(name) в порядке "C" отдаёт префиксные
+    # совпадения уже отсортированными. Триграммный GIN для подстрок от трёх символов
+    # (ix_products_name_trgm) создаёт только миграция: ему нужно расширение pg_trgm
+    # из contrib, которого может не быть в тестовой базе
+    __table_args__ = (
+        UniqueConstraint("name", "user_id", name="uq_product_name_user"),
+        Index("ix_products_user_lower_name", "user_id", text('lower(name) COLLATE "C"')),
+    )
 
     def __repr__(self):
         return f"<Product(id={self.id}, name={self.name}, price={self.price}, user_id={self.user_id})>"
 
 
+class ProductPriceHistory(Base):
+    __tablename__ = "product_price_history"
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    price = Column(Float, nullable=False)
+    # Цена действует в [valid_from, valid_to); у текущей цены valid_to пустой
+    valid_from = Column(DateTime, nullable=False)
+    valid_to = Column(DateTime)
+
+    # Цена на момент T - одна строка по (product_id, valid_from <= T) с конца индекса;
+    # открытый интервал у товара всегда один
+    __table_args__ = (
+        Index("ix_product_price_history_product_from", "product_id", "valid_from"),
+        Index("uq_product_price_history_open", "product_id", unique=True, postgresql_where=text("valid_to IS NULL")),
+    )
+
+    def __repr__(self):
+        return f"<ProductPriceHistory(product_id={self.product_id}, price={self.price}, valid_from={self.valid_from}, valid_to={self.valid_to})>"
+
+
 class Sale(Base):
     __tablename__ = "sales"
 
@@ -90,26 +119,131 @@ class Sale(Base):
     product = relationship("Product")
     user = relationship("User")
 
+    __table_args__ = (Index("ix_sales_user_date_id", "user_id", "date_sold", "id"),)
+
     def __repr__(self):
         return f"<Sale(id={self.id}, product_id={self.product_id}, quantity={self.quantity}, total_price={self.total_price}, user_id={self.user_id})>"
 
 
+class StockMovement(Base):
+    __tablename__ = "stock_movements"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # Журнал живёт, пока жив товар: удаление товара удаляет и его историю
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    # receipt, sale, adjustment, reversal или snapshot (см. backend/ledger.py)
+    kind = Column(String(20), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    balance_after = Column(Integer, nullable=False)
+    # Без внешнего ключа: журнал сохраняет ссылку и на удалённую продажу
+    sale_id = Column(Integer, index=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (Index("ix_stock_movements_user_product_created", "user_id", "product_id", "created_at", "id"),)
+
+    def __repr__(self):
+        return f"<StockMovement(id={self.id}, product_id={self.product_id}, kind={self.kind}, quantity={self.quantity}, balance_after={self.balance_after})>"
+
+
+class SalesDailyRollup(Base):
+    __tablename__ = "sales_daily_rollup"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_sales_daily_rollup_user_day", "user_id", "day"),)
+
+    def __repr__(self):
+        return f"<SalesDailyRollup(user_id={self.user_id}, product_id={self.product_id}, day={self.day}, units={self.units}, revenue={self.revenue})>"
+
+
 class Stock(Base):
     __tablename__ = "stock"
 
     id = Column(Integer, primary_key=True)
     product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
     quantity = Column(Integer, nullable=False, default=0)
+    # Сумма активных резервов (stock_reservations); доступно = quantity - reserved
+    reserved = Column(Integer, nullable=False, default=0, server_default="0")
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    minimum_quantity = Column(Integer, default=10)
+    minimum_quantity = Column(Integer, nullable=False, default=10, server_default="10")
 
     product = relationship("Product")
     user = relationship("User")
 
+    # Частичный индекс содержит только строки ниже порога, поэтому экран дозаказа
+    # не зависит от общего числа позиций на складе
+    __table_args__ = (
+        UniqueConstraint("product_id", "user_id", name="uq_stock_product_user"),
+        Index("ix_stock_low", "user_id", "id", postgresql_where=text("quantity < minimum_quantity")),
+    )
+
     def __repr__(self):
         return f"<Stock(id={self.id}, product_id={self.product_id}, quantity={self.quantity}, user_id={self.user_id})>"
 
 
+class ReorderSuggestion(Base):
+    __tablename__ = "reorder_suggestions"
+
+    # Результат backend/forecast.py, по строке на позицию склада
+    stock_id = Column(Integer, ForeignKey("stock.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    avg_daily_demand = Column(Float, nullable=False)
+    demand_std = Column(Float, nullable=False)
+    # NULL, если за окно прогноза продаж не было
+    days_of_cover = Column(Float)
+    reorder_point = Column(Integer, nullable=False)
+    order_quantity = Column(Integer, nullable=False)
+    computed_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<ReorderSuggestion(stock_id={self.stock_id}, reorder_point={self.reorder_point}, order_quantity={self.order_quantity})>"
+
+
+class ReportJob(Base):
+    __tablename__ = "report_jobs"
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    status = Column(String(20), nullable=False, default="pending")
+    error = Column(String(500))
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    finished_at = Column(DateTime)
+
+    user = relationship("User")
+
+    def __repr__(self):
+        return f"<ReportJob(id={self.id}, status={self.status}, user_id={self.user_id})>"
+
+
+class StockReservation(Base):
+    __tablename__ = "stock_reservations"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    # active, confirmed, released или expired
+    status = Column(String(20), nullable=False, default="active")
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    sale_id = Column(Integer, ForeignKey("sales.id", ondelete="SET NULL"))
+
+    product = relationship("Product")
+    user = relationship("User")
+
+    __table_args__ = (
+        Index("ix_stock_reservations_active_expires", "expires_at", postgresql_where=text("status = 'active'")),
+    )
+
+    def __repr__(self):
+        return f"<StockReservation(id={self.id}, product_id={self.product_id}, quantity={self.quantity}, status={self.status})>"
+
+
 class User(Base):
     __tablename__ = "users"
 
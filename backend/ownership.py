@@ -0,0 +1,56 @@
+from fastapi import HTTPException
+from sqlalchemy import select, exists
+from sqlalchemy.ext.asyncio import AsyncSession
+from backend.models import Manufacturer, Counterparty, Agreement, Product, Stock, Sale
+
+# Ошибка, если ссылка из формы указывает на чужую или несуществующую запись
+REFERENCE_ERRORS = {
+    Manufacturer: (403, "You don't have permission to use this manufacturer"),
+    Counterparty: (403, "You don't have permission to use this counterparty"),
+    Agreement: (403, "You don't have permission to use this agreement"),
+    Product: (404, "Product not found or you don't have permission")
+}
+
+# Ошибка, если не найдена сама редактируемая запись
+NOT_FOUND_ERRORS = {
+    Product: "Product not found or you don't have permission",
+    Agreement: "Agreement not found or you don't have permission",
+    Stock: "Stock not found or you don't have permission",
+    Sale: "Sale not found or you don't have permission"
+}
+
+
+def ownership_checks(user_id: int, refs):
+    # refs - список пар (модель, id); на каждую ссылку - колонка EXISTS в одном SELECT
+    return [
+        exists().where(model.id == ref_id, model.user_id == user_id).label(f"owned_{index}")
+        for index, (model, ref_id) in enumerate(refs)
+    ]
+
+
+def raise_for_foreign(refs, flags):
+    for (model, _), owned in zip(refs, flags):
+        if not owned:
+            status_code, detail = REFERENCE_ERRORS[model]
+            raise HTTPException(status_code=status_code, detail=detail)
+
+
+async def check_ownership(db: AsyncSession, user_id: int, refs):
+    # Все ссылки проверяются за один запрос; ошибка - по первой чужой ссылке
+    if not refs:
+        return
+    flags = (await db.execute(select(*ownership_checks(user_id, refs)))).first()
+    raise_for_foreign(refs, flags)
+
+
+async def load_owned(db: AsyncSession, user_id: int, model, obj_id: int, refs=(), lock: bool = False):
+    # Редактируемая запись и проверка всех её новых ссылок - тем же одним запросом
+    query = select(model, *ownership_checks(user_id, refs)).filter(model.id == obj_id, model.user_id == user_id)
+    if lock:
+        # Строка блокируется до конца транзакции и перечитывается, даже если уже есть в сессии
+        query = query.with_for_update(of=model).execution_options(populate_existing=True)
+    row = (await db.execute(query)).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail=NOT_FOUND_ERRORS[model])
+    raise_for_foreign(refs, row[1:])
+    return row[0]
@@ -0,0 +1,49 @@
+import datetime
+from sqlalchemy import select, update, insert, or_, values, column, true, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
+from backend.models import ProductPriceHistory
+
+
+async def record_price_changes(db: AsyncSession, user_id: int, changes, at: datetime.datetime = None):
+    # changes - пары (product_id, новая цена); открытые интервалы закрываются
+    # моментом at, новые открываются с него же. Выполняется в транзакции записи товара
+    changes = dict(changes)
+    if not changes:
+        return
+    at = at or datetime.datetime.utcnow()
+    await db.execute(
+        update(ProductPriceHistory)
+        .where(ProductPriceHistory.product_id.in_(changes.keys()), ProductPriceHistory.valid_to.is_(None))
+        .values(valid_to=at)
+        .execution_options(synchronize_session=False)
+    )
+    await db.execute(insert(ProductPriceHistory), [
+        {"product_id": product_id, "user_id": user_id, "price": price, "valid_from": at}
+        for product_id, price in changes.items()
+    ])
+
+
+async def prices_at(db: AsyncSession, user_id: int, product_ids, at: datetime.datetime):
+    # На каждый товар - LATERAL ... LIMIT 1: одна проба индекса (product_id, valid_from)
+    # с конца, без прохода по всей истории цен до момента at
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+    requested = values(column("product_id", Integer), name="requested").data([(product_id,) for product_id in product_ids])
+    latest = (
+        select(ProductPriceHistory.product_id, ProductPriceHistory.price, ProductPriceHistory.valid_from, ProductPriceHistory.valid_to)
+        .filter(
+            ProductPriceHistory.product_id == requested.c.product_id,
+            ProductPriceHistory.user_id == user_id,
+            ProductPriceHistory.valid_from <= at
+        )
+        .order_by(ProductPriceHistory.valid_from.desc())
+        .limit(1)
+        .lateral("latest")
+    )
+    result = await db.execute(
+        select(latest.c.product_id, latest.c.price, latest.c.valid_from)
+        .select_from(requested.join(latest, true()))
+        .filter(or_(latest.c.valid_to.is_(None), latest.c.valid_to > at))
+    )
+    return {row.product_id: row for row in result}
@@ -0,0 +1,33 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from backend.cache import LRUCache
+from backend.models import Manufacturer, Counterparty, Agreement
+from config import REFERENCE_CACHE_SIZE, REFERENCE_CACHE_TTL
+
+MANUFACTURERS = "manufacturers"
+COUNTERPARTIES = "counterparties"
+AGREEMENTS = "agreements"
+
+# Для выпадающих списков нужны только id и подпись
+REFERENCE_QUERIES = {
+    MANUFACTURERS: lambda user_id: select(Manufacturer.id, Manufacturer.name).filter(Manufacturer.user_id == user_id),
+    COUNTERPARTIES: lambda user_id: select(Counterparty.id, Counterparty.name).filter(Counterparty.user_id == user_id),
+    AGREEMENTS: lambda user_id: select(Agreement.id, Agreement.contract_number).filter(Agreement.user_id == user_id)
+}
+
+# Сброс происходит в обработчиках записи своего процесса; TTL ограничивает
+# устаревание в остальных воркерах
+reference_cache = LRUCache(REFERENCE_CACHE_SIZE, REFERENCE_CACHE_TTL)
+
+
+async def get_reference(db: AsyncSession, user_id: int, kind: str):
+    key = (user_id, kind)
+    rows = reference_cache.get(key)
+    if rows is None:
+        rows = (await db.execute(REFERENCE_QUERIES[kind](user_id))).all()
+        reference_cache.set(key, rows)
+    return rows
+
+
+def invalidate_reference(user_id: int, kind: str):
+    reference_cache.invalidate((user_id, kind))
@@ -0,0 +1,64 @@
+import csv
+import datetime
+import os
+from openpyxl import Workbook
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from backend.database import DATABASE_URL
+from backend.models import ReportJob
+from config import REPORT_JOBS_DIR, logger
+from routes.export import sales_query, stock_query, stream_rows, SALES_COLUMNS, STOCK_COLUMNS
+
+REPORT_FILES = {
+    "sales.csv": "text/csv",
+    "stocks.csv": "text/csv",
+    "report.xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+}
+
+def job_path(job_id: str, filename: str) -> str:
+    return os.path.join(REPORT_JOBS_DIR, job_id, filename)
+
+async def write_section(session_factory, query, columns, csv_path, sheet):
+    # Одно чтение серверным курсором пишет и CSV, и лист XLSX
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        sheet.append(columns)
+        async for partition in stream_rows(session_factory, query):
+            writer.writerows(partition)
+            for row in partition:
+                sheet.append(list(row))
+
+async def set_status(session_factory, job_id: str, status: str, error: str = None):
+    async with session_factory() as db:
+        job = await db.get(ReportJob, job_id)
+        job.status = status
+        job.error = error
+        if status in ("done", "failed"):
+            job.finished_at = datetime.datetime.utcnow()
+        await db.commit()
+        return job
+
+async def run_report_job(job_id: str):
+    # Задача выполняется в своём event loop (воркер Celery или поток в eager-режиме),
+    # поэтому берёт отдельный движок без пула вместо общего движка приложения
+    engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
+    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    try:
+        job = await set_status(session_factory, job_id, "running")
+        os.makedirs(os.path.join(REPORT_JOBS_DIR, job_id), exist_ok=True)
+        workbook = Workbook(write_only=True)
+        await write_section(session_factory, sales_query(job.user_id), SALES_COLUMNS,
+                            job_path(job_id, "sales.csv"), workbook.create_sheet("Продажи"))
+        await write_section(session_factory, stock_query(job.user_id), STOCK_COLUMNS,
+                            job_path(job_id, "stocks.csv"), workbook.create_sheet("Остатки"))
+        workbook.save(job_path(job_id, "report.xlsx"))
+        await set_status(session_factory, job_id, "done")
+        logger.info(f"Отчёт {job_id} сформирован")
+    except Exception as e:
+        logger.error(f"Ошибка при формировании отчёта {job_id}: {str(e)}")
+        await set_status(session_factory, job_id, "failed", str(e)[:500])
+        raise
+    finally:
+        await engine.dispose()
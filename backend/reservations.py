@@ -0,0 +1,67 @@
+import asyncio
+import datetime
+from sqlalchemy import select, update, values, column, Integer
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import NullPool
+from backend.database import DATABASE_URL
+from backend.models import Stock, StockReservation
+from config import RESERVATION_EXPIRE_BATCH, logger
+
+async def release_reserved(db: AsyncSession, rows):
+    # rows - (user_id, product_id, quantity); счётчик reserved уменьшается одним UPDATE по VALUES
+    totals = {}
+    for user_id, product_id, quantity in rows:
+        totals[(user_id, product_id)] = totals.get((user_id, product_id), 0) + quantity
+    if not totals:
+        return
+    released = values(
+        column("user_id", Integer), column("product_id", Integer), column("quantity", Integer), name="released"
+    ).data([(user_id, product_id, quantity) for (user_id, product_id), quantity in totals.items()])
+    await db.execute(
+        update(Stock)
+        .where(Stock.user_id == released.c.user_id, Stock.product_id == released.c.product_id)
+        .values(reserved=Stock.reserved - released.c.quantity)
+        .execution_options(synchronize_session=False)
+    )
+
+async def expire_batch(db: AsyncSession, now: datetime.datetime, batch_size: int) -> int:
+    # Берём пачку просроченных резервов по частичному индексу на expires_at;
+    # SKIP LOCKED не даёт ждать резервы, которые прямо сейчас подтверждаются
+    expired = (
+        select(StockReservation.id)
+        .filter(StockReservation.status == "active", StockReservation.expires_at <= now)
+        .order_by(StockReservation.expires_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    rows = (await db.execute(
+        update(StockReservation)
+        .where(StockReservation.id.in_(expired.scalar_subquery()))
+        .values(status="expired")
+        .returning(StockReservation.user_id, StockReservation.product_id, StockReservation.quantity)
+        .execution_options(synchronize_session=False)
+    )).all()
+    await release_reserved(db, rows)
+    return len(rows)
+
+async def expire_reservations(batch_size: int = RESERVATION_EXPIRE_BATCH) -> int:
+    # Каждая пачка - отдельная транзакция, чтобы не держать блокировки долго.
+    # Вызывается из Celery, поэтому движок без пула создаётся на время вызова
+    engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
+    total = 0
+    try:
+        while True:
+            async with AsyncSession(engine) as db:
+                count = await expire_batch(db, datetime.datetime.utcnow(), batch_size)
+                await db.commit()
+            total += count
+            if count < batch_size:
+                break
+    finally:
+        await engine.dispose()
+    if total:
+        logger.info(f"Снято просроченных резервов: {total}")
+    return total
+
+if __name__ == "__main__":
+    asyncio.run(expire_reservations())
@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from backend.database import AsyncSessionLocal
+from backend.models import Sale, SalesDailyRollup, User
+from config import logger
+
+BACKFILL_USERS_PER_CHUNK = 100
+
+async def apply_sales_rollup(db: AsyncSession, user_id: int, deltas):
+    # deltas - итерируемое (product_id, date_sold, units, revenue); для отмены
+    # продажи передаются отрицательные значения. Выполняется в транзакции
+    # вызывающего кода одним INSERT ... ON CONFLICT DO UPDATE
+    rows = {}
+    for product_id, date_sold, units, revenue in deltas:
+        if date_sold is None:
+            continue
+        key = (product_id, date_sold.date())
+        total_units, total_revenue = rows.get(key, (0, 0))
+        rows[key] = (total_units + units, total_revenue + revenue)
+    if not rows:
+        return
+    stmt = insert(SalesDailyRollup).values([
+        {"user_id": user_id, "product_id": product_id, "day": day, "units": units, "revenue": revenue}
+        for (product_id, day), (units, revenue) in rows.items()
+    ])
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[SalesDailyRollup.user_id, SalesDailyRollup.product_id, SalesDailyRollup.day],
+        set_={
+            "units": SalesDailyRollup.units + stmt.excluded.units,
+            "revenue": SalesDailyRollup.revenue + stmt.excluded.revenue
+        }
+    ))
+
+async def rebuild_user_rollups(db: AsyncSession, user_ids):
+    await db.execute(delete(SalesDailyRollup).where(SalesDailyRollup.user_id.in_(user_ids)))
+    day = func.date(Sale.date_sold)
+    source = (
+        select(Sale.user_id, Sale.product_id, day, func.sum(Sale.quantity), func.sum(Sale.total_price))
+        .filter(Sale.user_id.in_(user_ids), Sale.date_sold.isnot(None))
+        .group_by(Sale.user_id, Sale.product_id, day)
+    )
+    await db.execute(
+        insert(SalesDailyRollup).from_select(["user_id", "product_id", "day", "units", "revenue"], source)
+    )
+
+async def backfill(chunk_size: int = BACKFILL_USERS_PER_CHUNK):
+    # Пересобирает витрину пачками пользователей, каждая пачка - своя транзакция
+    last_user_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            user_ids = (await db.execute(
+                select(User.id).filter(User.id > last_user_id).order_by(User.id).limit(chunk_size)
+            )).scalars().all()
+            if not user_ids:
+                break
+            await rebuild_user_rollups(db, user_ids)
+            await db.commit()
+        last_user_id = user_ids[-1]
+        logger.info(f"Витрина sales_daily_rollup пересобрана до user_id={last_user_id}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пересборка sales_daily_rollup из таблицы sales")
+    parser.add_argument("--chunk-size", type=int, default=BACKFILL_USERS_PER_CHUNK)
+    asyncio.run(backfill(parser.parse_args().chunk_size))
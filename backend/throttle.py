@@ -0,0 +1,113 @@
+import time
+from backend.cache import LRUCache
+from config import (
+    REDIS_URL, LOGIN_THROTTLE_BACKEND, LOGIN_THROTTLE_MAX_KEYS,
+    LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE, LOGIN_USERNAME_BURST, LOGIN_USERNAME_PER_MINUTE
+)
+
+# Корзина: tokens, updated. Пополнение и списание - атомарно внутри Redis
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+return {allowed, tostring(tokens)}
+"""
+
+
+class MemoryTokenBuckets:
+    # Корзины внутри процесса. Запись живёт столько, сколько корзина наполняется
+    # до полной; истечение TTL ничего не теряет. Вытеснение из LRU теряет: вытесненная
+    # опустошённая корзина вернётся полной. Поэтому maxsize должен превышать число
+    # разных ключей за время наполнения корзины, иначе перебор ключей сбрасывает
+    # лимит; при нескольких воркерах или под атакой - бэкенд redis
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.buckets = {}
+
+    def bucket_store(self, capacity: float, rate: float):
+        key = (capacity, rate)
+        if key not in self.buckets:
+            self.buckets[key] = LRUCache(self.maxsize, capacity / rate)
+        return self.buckets[key]
+
+    async def take(self, key: str, capacity: float, rate: float):
+        # Между чтением и записью нет await, поэтому в одном event loop это атомарно
+        store = self.bucket_store(capacity, rate)
+        now = time.monotonic()
+        tokens, updated = store.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        store.set(key, (tokens, now))
+        return allowed, tokens
+
+    def clear(self):
+        for store in self.buckets.values():
+            store.clear()
+
+
+class RedisTokenBuckets:
+    # Общие для всех воркеров корзины
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def take(self, key: str, capacity: float, rate: float):
+        allowed, tokens = await self.script(keys=[f"throttle:{key}"], args=[capacity, rate, time.time()])
+        return bool(allowed), float(tokens)
+
+    def clear(self):
+        pass
+
+
+class LoginThrottle:
+    # Две корзины на попытку входа: по IP и по имени пользователя.
+    # Проверяется до bcrypt, отказ ничего не стоит процессору
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.limits = {
+            "ip": (LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE / 60),
+            "username": (LOGIN_USERNAME_BURST, LOGIN_USERNAME_PER_MINUTE / 60)
+        }
+        self.rejected = {"ip": 0, "username": 0}
+
+    async def check(self, ip: str, username: str):
+        # None - вход разрешён, иначе через сколько секунд можно повторить
+        for scope, value in (("ip", ip), ("username", username.lower())):
+            capacity, rate = self.limits[scope]
+            allowed, tokens = await self.buckets.take(f"login:{scope}:{value}", capacity, rate)
+            if not allowed:
+                self.rejected[scope] += 1
+                return max(1, int((1 - tokens) / rate + 0.999))
+        return None
+
+    def stats(self):
+        return {"rejected_ip": self.rejected["ip"], "rejected_username": self.rejected["username"]}
+
+    def clear(self):
+        self.buckets.clear()
+
+
+def create_login_throttle():
+    if LOGIN_THROTTLE_BACKEND == "redis":
+        return LoginThrottle(RedisTokenBuckets(REDIS_URL))
+    return LoginThrottle(MemoryTokenBuckets(LOGIN_THROTTLE_MAX_KEYS))
+
+
+login_throttle = create_login_throttle()
@@ -0,0 +1,19 @@
+import csv
+import io
+from fastapi import HTTPException, UploadFile
+from openpyxl import load_workbook
+
+
+def read_table(upload: UploadFile, required_columns):
+    # Файл читается построчно (XLSX - в режиме read_only), целиком в память не попадает.
+    # Возвращает индексы колонок по имени и итератор (номер строки, значения)
+    if (upload.filename or "").lower().endswith(".xlsx"):
+        rows = load_workbook(upload.file, read_only=True).active.iter_rows(values_only=True)
+    else:
+        rows = csv.reader(io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline=""))
+    header = [str(cell).strip() if cell is not None else "" for cell in next(rows, [])]
+    missing = [column for column in required_columns if column not in header]
+    if missing:
+        names = ", ".join(required_columns[:-1]) + " and " + required_columns[-1] if len(required_columns) > 1 else required_columns[0]
+        raise HTTPException(status_code=400, detail=f"File must have {names} columns")
+    return {column: header.index(column) for column in header if column}, enumerate(rows, start=2)
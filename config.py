@@ -15,18 +15,76 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+
 celery_app = Celery(
     "your_project",
-    broker="redis://redis:6379/0",
-    backend="redis://redis:6379/0"
+    broker=REDIS_URL,
+    backend=REDIS_URL
 )
+# CELERY_TASK_ALWAYS_EAGER=1 выполняет задачи прямо в вызывающем процессе (локально и в тестах)
+celery_app.conf.task_always_eager = os.getenv("CELERY_TASK_ALWAYS_EAGER", "0") == "1"
+celery_app.conf.beat_schedule = {
+    "compact-stock-movements": {"task": "tasks.compact_stock_movements_task", "schedule": 24 * 60 * 60},
+    "expire-stock-reservations": {"task": "tasks.expire_reservations_task", "schedule": 60},
+    "forecast-reorder-points": {"task": "tasks.forecast_reorder_points_task", "schedule": 24 * 60 * 60}
+}
 
 SECRET = os.getenv('SECRET_KEY', 'your-secret-key-here')
+# Пользователи с доступом к /admin, через запятую
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# 0 - для работы через pgbouncer в режиме transaction
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() in ("1", "true", "yes")
+# Доля запросов, попадающих в лог, когда полный DB_ECHO выключен
+DB_ECHO_SAMPLE_RATE = float(os.getenv("DB_ECHO_SAMPLE_RATE", "0"))
 EMAIL_HOST = os.getenv("EMAIL_HOST", "smtp.mail.ru")
 EMAIL_PORT = os.getenv("EMAIL_PORT", "587")
 EMAIL_USER = os.getenv("EMAIL_USER")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 EMAIL_FROM = os.getenv("EMAIL_FROM")
 
+# memory - только для одного процесса: версии данных не видны другим воркерам;
+# local - отчёты в памяти воркера, версии в Redis; redis - всё в Redis
+REPORT_CACHE_BACKEND = os.getenv("REPORT_CACHE_BACKEND", "memory")
+REPORT_CACHE_TTL = int(os.getenv("REPORT_CACHE_TTL", "300"))
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "1024"))
+REPORT_JOBS_DIR = os.getenv("REPORT_JOBS_DIR", "reports")
+STOCK_LEDGER_RETENTION_DAYS = int(os.getenv("STOCK_LEDGER_RETENTION_DAYS", "365"))
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "900"))
+RESERVATION_TTL_MAX_SECONDS = int(os.getenv("RESERVATION_TTL_MAX_SECONDS", "86400"))
+RESERVATION_EXPIRE_BATCH = int(os.getenv("RESERVATION_EXPIRE_BATCH", "1000"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+LOGIN_THROTTLE_BACKEND = os.getenv("LOGIN_THROTTLE_BACKEND", "memory")
+# Для memory: больше, чем разных IP и имён за время наполнения корзины (burst / скорость),
+# иначе вытесненные из LRU корзины возвращаются полными и лимит сбрасывается
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv("LOGIN_THROTTLE_MAX_KEYS", "100000"))
+LOGIN_IP_BURST = int(os.getenv("LOGIN_IP_BURST", "20"))
+LOGIN_IP_PER_MINUTE = float(os.getenv("LOGIN_IP_PER_MINUTE", "20"))
+LOGIN_USERNAME_BURST = int(os.getenv("LOGIN_USERNAME_BURST", "5"))
+LOGIN_USERNAME_PER_MINUTE = float(os.getenv("LOGIN_USERNAME_PER_MINUTE", "5"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60"))
+# Доверять id и email из подписанного токена и не обращаться к базе вовсе;
+# смена email тогда видна только после перевыпуска токена
+AUTH_TRUST_TOKEN_CLAIMS = os.getenv("AUTH_TRUST_TOKEN_CLAIMS", "false").lower() in ("1", "true", "yes")
+REFERENCE_CACHE_SIZE = int(os.getenv("REFERENCE_CACHE_SIZE", "1024"))
+REFERENCE_CACHE_TTL = int(os.getenv("REFERENCE_CACHE_TTL", "300"))
+STOCK_EVENTS_BACKEND = os.getenv("STOCK_EVENTS_BACKEND", "memory")
+STOCK_EVENTS_QUEUE_SIZE = int(os.getenv("STOCK_EVENTS_QUEUE_SIZE", "100"))
+STOCK_EVENTS_KEEPALIVE_SECONDS = int(os.getenv("STOCK_EVENTS_KEEPALIVE_SECONDS", "15"))
+FORECAST_HISTORY_DAYS = int(os.getenv("FORECAST_HISTORY_DAYS", "730"))
+FORECAST_WINDOW_DAYS = int(os.getenv("FORECAST_WINDOW_DAYS", "28"))
+FORECAST_LEAD_TIME_DAYS = int(os.getenv("FORECAST_LEAD_TIME_DAYS", "7"))
+FORECAST_REVIEW_DAYS = int(os.getenv("FORECAST_REVIEW_DAYS", "7"))
+FORECAST_SERVICE_Z = float(os.getenv("FORECAST_SERVICE_Z", "1.65"))
+
 logger.info(f"EMAIL_USER: {EMAIL_USER}")
 logger.info(f"EMAIL_FROM: {EMAIL_FROM}")
\ No newline at end of file
@@ -2,16 +2,24 @@ from fastapi import Depends, Request
 from fastapi.responses import RedirectResponse
 from fastapi_login import LoginManager
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, event, inspect
 from backend.database import get_db
 from backend.models import User
-from config import SECRET, logger
+from backend.cache import LRUCache
+from config import SECRET, USER_CACHE_SIZE, USER_CACHE_TTL, AUTH_TRUST_TOKEN_CLAIMS, BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS, logger
 from passlib.context import CryptContext  # Add this for hashing
 from datetime import timedelta
 from jose import jwt, ExpiredSignatureError
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt отпускает GIL, поэтому хватает потоков; размер пула - предел числа
+# одновременных хэширований, остальные ждут в очереди, не блокируя event loop
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
 
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -19,6 +27,36 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+async def hash_password_async(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(password_executor, hash_password, password)
+
+async def verify_and_update_password(plain_password: str, hashed_password: str):
+    # (совпал ли пароль, новый хэш или None); новый хэш - если у старого
+    # другая стоимость, чем BCRYPT_ROUNDS
+    return await asyncio.get_running_loop().run_in_executor(
+        password_executor, pwd_context.verify_and_update, plain_password, hashed_password
+    )
+
+class CurrentUser(NamedTuple):
+    # То, что обработчикам нужно от пользователя; не привязан к сессии
+    id: int
+    username: str
+    email: str
+
+# Ключ - subject токена (username). Промахи не кэшируются, поэтому новый
+# пользователь виден сразу, а изменения сбрасываются хуками ниже
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def invalidate_user(username: str):
+    user_cache.invalidate(username)
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_changed_user(mapper, connection, target):
+    invalidate_user(target.username)
+    for old_username in inspect(target).attrs.username.history.deleted or ():
+        invalidate_user(old_username)
+
 manager = LoginManager(SECRET, token_url="/login", use_cookie=True, cookie_name="auth_token")
 
 @manager.user_loader()
@@ -27,6 +65,18 @@ async def load_user(username: str, db: AsyncSession = Depends(get_db)):
     user = result.scalar_one_or_none()
     return user
 
+async def get_principal(username: str, payload: dict, db: AsyncSession):
+    if AUTH_TRUST_TOKEN_CLAIMS and payload.get("uid") is not None and payload.get("email") is not None:
+        return CurrentUser(payload["uid"], username, payload["email"])
+    principal = user_cache.get(username)
+    if principal is None:
+        user = await load_user(username, db)
+        if user is None:
+            return None
+        principal = CurrentUser(user.id, user.username, user.email)
+        user_cache.set(username, principal)
+    return principal
+
 async def get_current_user(request: Request, db: AsyncSession = Depends(get_db)):
     token = request.cookies.get("auth_token")
     if not token:
@@ -36,7 +86,7 @@ async def get_current_user(request: Request, db: AsyncSession = Depends(get_db))
         username = payload.get("sub")
         if not username:
             return RedirectResponse(url="/login", status_code=303)
-        user = await load_user(username, db)
+        user = await get_principal(username, payload, db)
         if user is None:
             return RedirectResponse(url="/login", status_code=303)
         return user
@@ -2,7 +2,7 @@ from fastapi import FastAPI, Depends, Request
 from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 from backend import auth
-from routes import agreement, counterparty, manufacturer, product, report, stock, sale
+from routes import agreement, counterparty, manufacturer, product, report, stock, sale, export, reservation, admin
 from dependencies import get_current_user
 
 app = FastAPI(
@@ -20,6 +20,9 @@ app.include_router(product.router, prefix="/product")
 app.include_router(sale.router, prefix="/sales")
 app.include_router(stock.router, prefix="/stocks")
 app.include_router(report.router, prefix="/report")
+app.include_router(export.router, prefix="/export")
+app.include_router(reservation.router, prefix="/reservations")
+app.include_router(admin.router, prefix="/admin")
 
 @app.get("/", summary="Главная страница", description="Отображает главную страницу для авторизованного пользователя")
 async def read_root(request: Request, user=Depends(get_current_user)):
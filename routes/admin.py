@@ -0,0 +1,26 @@
+from fastapi import APIRouter, Depends, HTTPException
+from backend.database import engine, pool_stats
+from backend.throttle import login_throttle
+from backend.cache import report_cache
+from backend.reference import reference_cache
+from dependencies import get_current_user, user_cache
+from config import ADMIN_USERNAMES
+
+router = APIRouter()
+
+def require_admin(user=Depends(get_current_user)):
+    if getattr(user, "username", None) not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
+
+@router.get("/pool", summary="Состояние пула соединений с базой")
+async def get_pool_stats(user=Depends(require_admin)):
+    return pool_stats.snapshot(engine.sync_engine.pool)
+
+@router.get("/throttle", summary="Отклонённые попытки входа")
+async def get_throttle_stats(user=Depends(require_admin)):
+    return login_throttle.stats()
+
+@router.get("/cache", summary="Попадания в кэши приложения")
+async def get_cache_stats(user=Depends(require_admin)):
+    return {"users": user_cache.stats(), "reference": reference_cache.stats(), "report": report_cache.stats()}
@@ -5,6 +5,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from backend.database import get_db
 from backend.models import Agreement, Counterparty
+from backend import reference
+from backend.reference import get_reference, invalidate_reference
+from backend.ownership import check_ownership, load_owned
 from dependencies import get_current_user
 from pydantic import BaseModel, validator
 from datetime import datetime
@@ -39,8 +42,7 @@ async def get_agreement(request: Request, db: AsyncSession = Depends(get_db), us
 @router.get("/create")
 async def create_agreement(request: Request, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
     try:
-        result = await db.execute(select(Counterparty).filter(Counterparty.user_id == user.id))
-        counterparties = result.scalars().all()
+        counterparties = await get_reference(db, user.id, reference.COUNTERPARTIES)
         return templates.TemplateResponse("create_agreement.html", {"request": request, "counterparties": counterparties})
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
@@ -55,9 +57,7 @@ async def create_agreement_post(
 ):
     try:
         agreement_data = AgreementCreate(contract_number=contract_number, date_signed=date_signed, counterparty_id=counterparty_id)
-        result = await db.execute(select(Counterparty).filter(Counterparty.id == agreement_data.counterparty_id, Counterparty.user_id == user.id))
-        if result.scalar_one_or_none() is None:
-            raise HTTPException(status_code=403, detail="You don't have permission to use this counterparty")
+        await check_ownership(db, user.id, [(Counterparty, agreement_data.counterparty_id)])
         new_agreement = Agreement(
             contract_number=agreement_data.contract_number,
             date_signed=agreement_data.date_signed,
@@ -66,6 +66,7 @@ async def create_agreement_post(
         )
         db.add(new_agreement)
         await db.commit()
+        invalidate_reference(user.id, reference.AGREEMENTS)
         return RedirectResponse(url="/agreement", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": Request, "error": str(e)})
@@ -77,8 +78,7 @@ async def edit_agreement(request: Request, agreement_id: int, db: AsyncSession =
         agreement = result.scalar_one_or_none()
         if agreement is None:
             raise HTTPException(status_code=404, detail="Agreement not found or you don't have permission")
-        result_counterparties = await db.execute(select(Counterparty).filter(Counterparty.user_id == user.id))
-        counterparties = result_counterparties.scalars().all()
+        counterparties = await get_reference(db, user.id, reference.COUNTERPARTIES)
         return templates.TemplateResponse("edit_agreement.html", {"request": request, "agreement": agreement, "counterparties": counterparties})
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
@@ -94,17 +94,12 @@ async def edit_agreement_post(
 ):
     try:
         agreement_data = AgreementUpdate(contract_number=contract_number, date_signed=date_signed, counterparty_id=counterparty_id)
-        result = await db.execute(select(Agreement).filter(Agreement.id == agreement_id, Agreement.user_id == user.id))
-        agreement = result.scalar_one_or_none()
-        if agreement is None:
-            raise HTTPException(status_code=404, detail="Agreement not found or you don't have permission")
-        result = await db.execute(select(Counterparty).filter(Counterparty.id == agreement_data.counterparty_id, Counterparty.user_id == user.id))
-        if result.scalar_one_or_none() is None:
-            raise HTTPException(status_code=403, detail="You don't have permission to use this counterparty")
+        agreement = await load_owned(db, user.id, Agreement, agreement_id, [(Counterparty, agreement_data.counterparty_id)])
         agreement.contract_number = agreement_data.contract_number
         agreement.date_signed = agreement_data.date_signed
         agreement.counterparty_id = agreement_data.counterparty_id
         await db.commit()
+        invalidate_reference(user.id, reference.AGREEMENTS)
         return RedirectResponse(url="/agreement", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": Request, "error": str(e)})
@@ -118,6 +113,7 @@ async def delete_agreement(agreement_id: int, db: AsyncSession = Depends(get_db)
             raise HTTPException(status_code=404, detail="Agreement not found or you don't have permission")
         await db.delete(agreement)
         await db.commit()
+        invalidate_reference(user.id, reference.AGREEMENTS)
         return RedirectResponse(url="/agreement", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": Request, "error": str(e)})
\ No newline at end of file
@@ -5,6 +5,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from backend.database import get_db
 from backend.models import Counterparty
+from backend import reference
+from backend.reference import invalidate_reference
 from dependencies import get_current_user
 
 router = APIRouter()
@@ -39,6 +41,7 @@ async def create_counterparty_post(
         new_counterparty = Counterparty(name=name, address=address, phone_number=phone_number, user_id=user.id)
         db.add(new_counterparty)
         await db.commit()
+        invalidate_reference(user.id, reference.COUNTERPARTIES)
         return RedirectResponse(url="/counterparty", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
@@ -73,6 +76,7 @@ async def edit_counterparty_post(
         counterparty.address = address
         counterparty.phone_number = phone_number
         await db.commit()
+        invalidate_reference(user.id, reference.COUNTERPARTIES)
         return RedirectResponse(url="/counterparty", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
@@ -91,6 +95,7 @@ async def delete_counterparty(
             raise HTTPException(status_code=404, detail="Counterparty not found or you don't have permission")
         await db.delete(counterparty)
         await db.commit()
+        invalidate_reference(user.id, reference.COUNTERPARTIES)
         return RedirectResponse(url="/counterparty", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
\ No newline at end of file
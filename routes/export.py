@@ -0,0 +1,93 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from backend.database import get_session_factory
+from backend.models import Sale, Stock, Product
+from dependencies import get_current_user
+import csv
+import datetime
+import io
+import json
+
+router = APIRouter()
+
+EXPORT_CHUNK_SIZE = 1000
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+SALES_COLUMNS = ["id", "date_sold", "product_id", "product_name", "quantity", "total_price"]
+STOCK_COLUMNS = ["id", "product_id", "product_name", "quantity", "minimum_quantity"]
+
+def sales_query(user_id: int):
+    return (
+        select(Sale.id, Sale.date_sold, Sale.product_id, Product.name.label("product_name"), Sale.quantity, Sale.total_price)
+        .join(Product, Product.id == Sale.product_id)
+        .filter(Sale.user_id == user_id)
+        .order_by(Sale.date_sold, Sale.id)
+    )
+
+def stock_query(user_id: int):
+    return (
+        select(Stock.id, Stock.product_id, Product.name.label("product_name"), Stock.quantity, Stock.minimum_quantity)
+        .join(Product, Product.id == Stock.product_id)
+        .filter(Stock.user_id == user_id)
+        .order_by(Stock.id)
+    )
+
+async def stream_rows(session_factory, query):
+    # db.stream() открывает серверный курсор: строки приходят пачками по
+    # EXPORT_CHUNK_SIZE, и в памяти никогда не лежит вся выборка
+    async with session_factory() as db:
+        result = await db.stream(query)
+        async for partition in result.partitions(EXPORT_CHUNK_SIZE):
+            yield partition
+
+def to_json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+async def csv_chunks(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    async for partition in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(partition)
+        yield buffer.getvalue()
+
+async def ndjson_chunks(rows, columns):
+    async for partition in rows:
+        yield "".join(
+            json.dumps({column: to_json_value(value) for column, value in zip(columns, row)}, ensure_ascii=False) + "\n"
+            for row in partition
+        )
+
+def export_response(session_factory, query, columns, export_format: str, name: str):
+    if export_format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Unsupported format. Use csv or ndjson")
+    rows = stream_rows(session_factory, query)
+    chunks = csv_chunks(rows, columns) if export_format == "csv" else ndjson_chunks(rows, columns)
+    filename = f"{name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    return StreamingResponse(
+        chunks,
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@router.get("/sales", summary="Выгрузка продаж (CSV/NDJSON)")
+async def export_sales(
+    format: str = Query("csv"),
+    session_factory=Depends(get_session_factory),
+    user=Depends(get_current_user)
+):
+    return export_response(session_factory, sales_query(user.id), SALES_COLUMNS, format, "sales")
+
+@router.get("/stocks", summary="Выгрузка остатков (CSV/NDJSON)")
+async def export_stocks(
+    format: str = Query("csv"),
+    session_factory=Depends(get_session_factory),
+    user=Depends(get_current_user)
+):
+    return export_response(session_factory, stock_query(user.id), STOCK_COLUMNS, format, "stocks")
@@ -5,6 +5,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from backend.database import get_db
 from backend.models import Manufacturer
+from backend import reference
+from backend.reference import invalidate_reference
 from dependencies import get_current_user
 
 router = APIRouter()
@@ -40,6 +42,7 @@ async def create_manufacturer_post(
         new_manufacturer = Manufacturer(name=name, address=address, manager=manager, phone_number=phone_number, user_id=user.id)
         db.add(new_manufacturer)
         await db.commit()
+        invalidate_reference(user.id, reference.MANUFACTURERS)
         return RedirectResponse(url="/manufacturer", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
@@ -85,6 +88,7 @@ async def edit_manufacturer_post(
         manufacturer.manager = manager
         manufacturer.phone_number = phone_number
         await db.commit()
+        invalidate_reference(user.id, reference.MANUFACTURERS)
         return RedirectResponse(url="/manufacturer", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
@@ -105,6 +109,7 @@ async def delete_manufacturer(
             raise HTTPException(status_code=404, detail="Manufacturer not found or you don't have permission")
         await db.delete(manufacturer)
         await db.commit()
+        invalidate_reference(user.id, reference.MANUFACTURERS)
         return RedirectResponse(url="/manufacturer", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
\ No newline at end of file
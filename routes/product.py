@@ -1,23 +1,146 @@
-from fastapi import APIRouter, Depends, Form, Request, HTTPException
+from fastapi import APIRouter, Depends, Form, Request, HTTPException, Query, UploadFile, File
 from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, func, tuple_, literal_column
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import joinedload
 from backend.database import get_db
 from backend.models import Product, Manufacturer, Counterparty, Agreement
+from backend.cache import bump_data_version
+from backend import reference
+from backend.reference import get_reference
+from backend.ownership import check_ownership, load_owned
+from backend.uploads import read_table
+from backend.prices import record_price_changes, prices_at
+from routes.stock import parse_moment
 from dependencies import get_current_user
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
+import base64
+import datetime
+import json
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 
+PRODUCT_SEARCH_LIMIT = 20
+PRODUCT_SEARCH_LIMIT_MAX = 100
+# Короче трёх символов триграммы не работают, такие запросы ищут по префиксу
+TRIGRAM_MIN_LENGTH = 3
+PRODUCT_IMPORT_CHUNK = 1000
+PRICE_LOOKUP_MAX = 1000
+CATALOGUE_COLUMNS = ["name", "price", "manufacturer", "counterparty", "agreement"]
+CATALOGUE_REFERENCES = [
+    ("manufacturer", reference.MANUFACTURERS, "Manufacturer"),
+    ("counterparty", reference.COUNTERPARTIES, "Counterparty"),
+    ("agreement", reference.AGREEMENTS, "Agreement")
+]
+
 class ProductResponse(BaseModel):
     id: int
     name: str
     price: float
 
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def encode_product_cursor(name_key: str, product_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([name_key, product_id]).encode()).decode()
+
+def decode_product_cursor(cursor: str):
+    try:
+        name_key, product_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(name_key), int(product_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def name_index(rows):
+    # Подпись справочника -> id; None, если подпись у пользователя не уникальна
+    index = {}
+    for row in rows:
+        key = str(row[1]).strip()
+        index[key] = None if key in index else row[0]
+    return index
+
+def read_catalogue_rows(upload: UploadFile, references):
+    columns, rows = read_table(upload, CATALOGUE_COLUMNS)
+    seen = set()
+    for number, row in rows:
+        try:
+            values = {column: row[columns[column]] for column in CATALOGUE_COLUMNS}
+        except IndexError:
+            yield number, None, "Missing columns"
+            continue
+        name = str(values["name"] or "").strip()
+        if not name or len(name) > 150:
+            yield number, None, "Invalid product name"
+            continue
+        try:
+            price = float(values["price"])
+        except (TypeError, ValueError):
+            yield number, None, "Invalid price"
+            continue
+        if price < 0:
+            yield number, None, "Price must not be negative"
+            continue
+        if name in seen:
+            yield number, None, "Duplicate product name in file"
+            continue
+        record = {"name": name, "price": price}
+        error = None
+        for column, kind, label in CATALOGUE_REFERENCES:
+            value = str(values[column] or "").strip()
+            if value not in references[kind]:
+                error = f"{label} not found or you don't have permission"
+                break
+            if references[kind][value] is None:
+                error = f"Ambiguous {column} name"
+                break
+            record[f"{column}_id"] = references[kind][value]
+        if error:
+            yield number, None, error
+            continue
+        seen.add(name)
+        yield number, record, None
+
+async def upsert_products(db: AsyncSession, user_id: int, records):
+    # Один INSERT ... ON CONFLICT (name, user_id) DO UPDATE на пачку;
+    # xmax = 0 у вставленных строк и не 0 у обновлённых. Старые цены читаются
+    # заранее: в историю цен попадают только новые товары и изменённые цены
+    old_prices = dict((await db.execute(
+        select(Product.name, Product.price).filter(Product.user_id == user_id, Product.name.in_([record["name"] for record in records]))
+    )).all())
+    stmt = insert(Product).values([{**record, "user_id": user_id} for record in records])
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_product_name_user",
+        set_={column: stmt.excluded[column] for column in ("price", "manufacturer_id", "counterparty_id", "agreement_id")}
+    ).returning(Product.id, Product.name, Product.price, literal_column("xmax = 0").label("inserted"))
+    rows = (await db.execute(stmt)).all()
+    await record_price_changes(db, user_id, [(row.id, row.price) for row in rows if old_prices.get(row.name) != row.price])
+    inserted = sum(1 for row in rows if row.inserted)
+    return inserted, len(rows) - inserted
+
+async def import_catalogue(db: AsyncSession, user_id: int, upload: UploadFile):
+    # Названия справочников сопоставляются с id один раз на весь файл
+    references = {kind: name_index(await get_reference(db, user_id, kind)) for _, kind, _ in CATALOGUE_REFERENCES}
+    errors = []
+    inserted = updated = lines = 0
+    chunk = []
+    for number, record, error in read_catalogue_rows(upload, references):
+        lines += 1
+        if error:
+            errors.append({"line": number, "error": error})
+            continue
+        chunk.append(record)
+        if len(chunk) >= PRODUCT_IMPORT_CHUNK:
+            chunk_inserted, chunk_updated = await upsert_products(db, user_id, chunk)
+            inserted, updated, chunk = inserted + chunk_inserted, updated + chunk_updated, []
+    if chunk:
+        chunk_inserted, chunk_updated = await upsert_products(db, user_id, chunk)
+        inserted, updated = inserted + chunk_inserted, updated + chunk_updated
+    return {"lines": lines, "inserted": inserted, "updated": updated, "failed": len(errors), "errors": errors}
+
 @router.get("", summary="Список продуктов")
 async def get_products(request: Request, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
     try:
@@ -45,12 +168,91 @@ async def get_products_api(db: AsyncSession = Depends(get_db), user=Depends(get_
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))  # API endpoint keeps HTTP exception
 
+@router.get("/api/search", summary="Поиск продуктов для автодополнения (API)")
+async def search_products_api(
+    q: str = Query("", max_length=150),
+    limit: int = Query(PRODUCT_SEARCH_LIMIT, ge=1, le=PRODUCT_SEARCH_LIMIT_MAX),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    user=Depends(get_current_user)
+):
+    try:
+        # Порядок и keyset-страницы по (lower(name) COLLATE "C", id) совпадают с
+        # ix_products_user_lower_name; на других СУБД тот же запрос идёт обычным LIKE
+        name_key = func.lower(Product.name).collate("C")
+        query = select(Product.id, Product.name, Product.price, name_key.label("name_key")).filter(Product.user_id == user.id)
+        term = q.strip().lower()
+        if len(term) >= TRIGRAM_MIN_LENGTH:
+            query = query.filter(Product.name.ilike(f"%{escape_like(term)}%", escape="\\"))
+        elif term:
+            query = query.filter(name_key.like(f"{escape_like(term)}%", escape="\\"))
+        if cursor:
+            query = query.filter(tuple_(name_key, Product.id) > tuple_(*decode_product_cursor(cursor)))
+        rows = (await db.execute(query.order_by(name_key, Product.id).limit(limit + 1))).all()
+        next_cursor = encode_product_cursor(rows[limit - 1].name_key, rows[limit - 1].id) if len(rows) > limit else None
+        return {
+            "items": [{"id": row.id, "name": row.name, "price": row.price} for row in rows[:limit]],
+            "next_cursor": next_cursor
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/import", summary="Загрузка каталога товаров из CSV/XLSX")
+async def import_products(file: UploadFile = File(...), db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    try:
+        # Все пачки - в одной транзакции: файл применяется целиком или не применяется
+        result = await import_catalogue(db, user.id, file)
+        await db.commit()
+        await bump_data_version(user.id)
+        return result
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/api/prices", summary="Цены нескольких продуктов на момент времени (API)")
+async def get_prices_api(
+    product_id: List[int] = Query(...),
+    at: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    user=Depends(get_current_user)
+):
+    if len(product_id) > PRICE_LOOKUP_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {PRICE_LOOKUP_MAX} products per request")
+    moment = parse_moment(at, datetime.datetime.utcnow())
+    try:
+        prices = await prices_at(db, user.id, product_id, moment)
+        return {
+            "at": moment,
+            "prices": [
+                {"product_id": pid, "price": prices[pid].price if pid in prices else None, "valid_from": prices[pid].valid_from if pid in prices else None}
+                for pid in product_id
+            ]
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/api/prices/{product_id}", summary="Цена продукта на момент времени (API)")
+async def get_price_api(product_id: int, at: Optional[str] = None, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    moment = parse_moment(at, datetime.datetime.utcnow())
+    try:
+        price = (await prices_at(db, user.id, [product_id], moment)).get(product_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if price is None:
+        raise HTTPException(status_code=404, detail="No price for this product at the given time")
+    return {"product_id": product_id, "at": moment, "price": price.price, "valid_from": price.valid_from}
+
 @router.get("/create", summary="Форма создания продукта")
 async def create_product(request: Request, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
     try:
-        manufacturers = (await db.execute(select(Manufacturer).filter(Manufacturer.user_id == user.id))).scalars().all()
-        counterparties = (await db.execute(select(Counterparty).filter(Counterparty.user_id == user.id))).scalars().all()
-        agreements = (await db.execute(select(Agreement).filter(Agreement.user_id == user.id))).scalars().all()
+        manufacturers = await get_reference(db, user.id, reference.MANUFACTURERS)
+        counterparties = await get_reference(db, user.id, reference.COUNTERPARTIES)
+        agreements = await get_reference(db, user.id, reference.AGREEMENTS)
         return templates.TemplateResponse("create_product.html", {
             "request": request,
             "manufacturers": manufacturers,
@@ -72,15 +274,9 @@ async def create_product_post(
     user=Depends(get_current_user)
 ):
     try:
-        result = await db.execute(select(Manufacturer).filter(Manufacturer.id == manufacturer_id, Manufacturer.user_id == user.id))
-        if result.scalar_one_or_none() is None:
-            raise HTTPException(status_code=403, detail="You don't have permission to use this manufacturer")
-        result = await db.execute(select(Counterparty).filter(Counterparty.id == counterparty_id, Counterparty.user_id == user.id))
-        if result.scalar_one_or_none() is None:
-            raise HTTPException(status_code=403, detail="You don't have permission to use this counterparty")
-        result = await db.execute(select(Agreement).filter(Agreement.id == agreement_id, Agreement.user_id == user.id))
-        if result.scalar_one_or_none() is None:
-            raise HTTPException(status_code=403, detail="You don't have permission to use this agreement")
+        await check_ownership(db, user.id, [
+            (Manufacturer, manufacturer_id), (Counterparty, counterparty_id), (Agreement, agreement_id)
+        ])
         new_product = Product(
             name=name,
             price=price,
@@ -90,6 +286,8 @@ async def create_product_post(
             user_id=user.id
         )
         db.add(new_product)
+        await db.flush()
+        await record_price_changes(db, user.id, [(new_product.id, price)])
         await db.commit()
         return RedirectResponse(url="/product", status_code=303)
     except Exception as e:
@@ -102,9 +300,9 @@ async def edit_product(request: Request, product_id: int, db: AsyncSession = Dep
         product = result.scalar_one_or_none()
         if not product:
             raise HTTPException(status_code=404, detail="Product not found or you don't have permission")
-        manufacturers = (await db.execute(select(Manufacturer).filter(Manufacturer.user_id == user.id))).scalars().all()
-        counterparties = (await db.execute(select(Counterparty).filter(Counterparty.user_id == user.id))).scalars().all()
-        agreements = (await db.execute(select(Agreement).filter(Agreement.user_id == user.id))).scalars().all()
+        manufacturers = await get_reference(db, user.id, reference.MANUFACTURERS)
+        counterparties = await get_reference(db, user.id, reference.COUNTERPARTIES)
+        agreements = await get_reference(db, user.id, reference.AGREEMENTS)
         return templates.TemplateResponse("edit_product.html", {
             "request": request,
             "product": product,
@@ -128,25 +326,18 @@ async def edit_product_post(
     user=Depends(get_current_user)
 ):
     try:
-        result = await db.execute(select(Product).filter(Product.id == product_id, Product.user_id == user.id))
-        product = result.scalar_one_or_none()
-        if not product:
-            raise HTTPException(status_code=404, detail="Product not found or you don't have permission")
-        result = await db.execute(select(Manufacturer).filter(Manufacturer.id == manufacturer_id, Manufacturer.user_id == user.id))
-        if result.scalar_one_or_none() is None:
-            raise HTTPException(status_code=403, detail="You don't have permission to use this manufacturer")
-        result = await db.execute(select(Counterparty).filter(Counterparty.id == counterparty_id, Counterparty.user_id == user.id))
-        if result.scalar_one_or_none() is None:
-            raise HTTPException(status_code=403, detail="You don't have permission to use this counterparty")
-        result = await db.execute(select(Agreement).filter(Agreement.id == agreement_id, Agreement.user_id == user.id))
-        if result.scalar_one_or_none() is None:
-            raise HTTPException(status_code=403, detail="You don't have permission to use this agreement")
+        product = await load_owned(db, user.id, Product, product_id, [
+            (Manufacturer, manufacturer_id), (Counterparty, counterparty_id), (Agreement, agreement_id)
+        ])
+        if product.price != price:
+            await record_price_changes(db, user.id, [(product.id, price)])
         product.name = name
         product.price = price
         product.manufacturer_id = manufacturer_id
         product.counterparty_id = counterparty_id
         product.agreement_id = agreement_id
         await db.commit()
+        await bump_data_version(user.id)
         return RedirectResponse(url="/product", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
@@ -165,6 +356,7 @@ async def delete_product(
             raise HTTPException(status_code=404, detail="Product not found or you don't have permission")
         await db.delete(product)
         await db.commit()
+        await bump_data_version(user.id)
         return RedirectResponse(url="/product", status_code=303)
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
\ No newline at end of file
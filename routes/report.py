@@ -1,42 +1,191 @@
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, Request, Query, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
+from sqlalchemy import select, func
 from backend.database import get_db
-from backend.models import Sale, Stock
+from backend.models import Sale, Stock, Product, SalesDailyRollup, ReportJob
+from backend.report_jobs import REPORT_FILES, job_path
 from dependencies import get_current_user
+from backend.cache import report_cache
+from routes.sale import encode_cursor, after_cursor, parse_date
+from tasks import generate_report_task
+from typing import Optional
+from urllib.parse import urlencode
 import datetime
+import os
+import uuid
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 
-@router.get("", summary="Генерация отчета")
-async def generate_report(request: Request, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
-    try:
-        result_sales = await db.execute(
-            select(Sale)
-            .filter(Sale.user_id == user.id)
-            .options(joinedload(Sale.product))
+REPORT_DETAIL_LIMIT = 50
+REPORT_DAYS = 30
+
+async def sales_totals(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        select(
+            func.coalesce(func.sum(SalesDailyRollup.units), 0).label("units"),
+            func.coalesce(func.sum(SalesDailyRollup.revenue), 0).label("revenue")
+        ).filter(SalesDailyRollup.user_id == user_id)
+    )
+    return result.one()
+
+async def sales_by_product(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        select(
+            Product.id,
+            Product.name,
+            func.sum(SalesDailyRollup.units).label("units"),
+            func.sum(SalesDailyRollup.revenue).label("revenue")
         )
-        sales = result_sales.scalars().all()
-        result_stocks = await db.execute(
-            select(Stock)
-            .filter(Stock.user_id == user.id)
-            .options(joinedload(Stock.product))
+        .join(SalesDailyRollup, SalesDailyRollup.product_id == Product.id)
+        .filter(SalesDailyRollup.user_id == user_id)
+        .group_by(Product.id, Product.name)
+        .having(func.sum(SalesDailyRollup.units) != 0)
+        .order_by(func.sum(SalesDailyRollup.revenue).desc())
+    )
+    return result.all()
+
+async def sales_by_day(db: AsyncSession, user_id: int, start: datetime.date, end: datetime.date):
+    result = await db.execute(
+        select(
+            SalesDailyRollup.day,
+            func.sum(SalesDailyRollup.units).label("units"),
+            func.sum(SalesDailyRollup.revenue).label("revenue")
         )
-        stocks = result_stocks.scalars().all()
-        total_sales = sum(sale.total_price for sale in sales)
-        total_stock = sum(stock.quantity for stock in stocks)
+        .filter(SalesDailyRollup.user_id == user_id, SalesDailyRollup.day >= start, SalesDailyRollup.day < end)
+        .group_by(SalesDailyRollup.day)
+        .having(func.sum(SalesDailyRollup.units) != 0)
+        .order_by(SalesDailyRollup.day.desc())
+    )
+    return result.all()
+
+async def stock_summary(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        select(Product.name, Stock.quantity)
+        .join(Product, Product.id == Stock.product_id)
+        .filter(Stock.user_id == user_id)
+        .order_by(Product.name)
+    )
+    return result.all()
+
+async def sales_window(db: AsyncSession, user_id: int, cursor: Optional[str], limit: int):
+    query = (
+        select(Sale.id, Sale.date_sold, Sale.quantity, Sale.total_price, Product.name.label("product_name"))
+        .join(Product, Product.id == Sale.product_id)
+        .filter(Sale.user_id == user_id)
+    )
+    if cursor:
+        query = query.filter(after_cursor(cursor))
+    result = await db.execute(query.order_by(Sale.date_sold.desc(), Sale.id.desc()).limit(limit + 1))
+    rows = result.all()
+    next_cursor = encode_cursor(rows[limit - 1].date_sold, rows[limit - 1].id) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+async def build_report(db: AsyncSession, user_id: int, start: datetime.datetime, end: datetime.datetime, cursor: Optional[str], limit: int):
+    totals = await sales_totals(db, user_id)
+    stocks = await stock_summary(db, user_id)
+    sales, next_cursor = await sales_window(db, user_id, cursor, limit)
+    return {
+        "total_units": totals.units,
+        "total_sales": totals.revenue,
+        "by_product": [row._asdict() for row in await sales_by_product(db, user_id)],
+        "by_day": [row._asdict() for row in await sales_by_day(db, user_id, start.date(), end.date())],
+        "stocks": [row._asdict() for row in stocks],
+        "total_stock": sum(stock.quantity for stock in stocks),
+        "sales": [row._asdict() for row in sales],
+        "next_cursor": next_cursor
+    }
+
+@router.get("", summary="Генерация отчета")
+async def generate_report(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(REPORT_DETAIL_LIMIT, ge=1, le=500),
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    user=Depends(get_current_user)
+):
+    try:
+        # Итоги и разбивки читаются из витрины sales_daily_rollup; детальные
+        # строки загружаются только для одной страницы
+        end = (parse_date(date_to) or datetime.datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        start = parse_date(date_from) or end - datetime.timedelta(days=REPORT_DAYS)
+        version = await report_cache.get_version(user.id)
+        cache_key = (user.id, version, start.date(), end.date(), cursor, limit)
+        data = await report_cache.get(cache_key)
+        if data is None:
+            data = await build_report(db, user.id, start, end, cursor, limit)
+            await report_cache.set(cache_key, data)
+        next_url = None
+        if data["next_cursor"]:
+            params = {"date_from": date_from, "date_to": date_to, "limit": limit, "cursor": data["next_cursor"]}
+            next_url = f"/report?{urlencode({key: value for key, value in params.items() if value})}"
         current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         return templates.TemplateResponse("report.html", {
             "request": request,
             "user": user,
-            "sales": sales,
-            "stocks": stocks,
-            "total_sales": total_sales,
-            "total_stock": total_stock,
+            "sales": data["sales"],
+            "next_url": next_url,
+            "date_from": start.strftime("%Y-%m-%d"),
+            "date_to": (end - datetime.timedelta(days=1)).strftime("%Y-%m-%d"),
+            "by_product": data["by_product"],
+            "by_day": data["by_day"],
+            "stocks": data["stocks"],
+            "total_units": data["total_units"],
+            "total_sales": data["total_sales"],
+            "total_stock": data["total_stock"],
             "current_date": current_date
         })
     except Exception as e:
-        return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
\ No newline at end of file
+        return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
+
+def job_response(job: ReportJob):
+    return {
+        "id": job.id,
+        "status": job.status,
+        "error": job.error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+        "files": {name: f"/report/jobs/{job.id}/download/{name}" for name in REPORT_FILES} if job.status == "done" else {}
+    }
+
+async def get_user_job(db: AsyncSession, job_id: str, user_id: int) -> ReportJob:
+    result = await db.execute(select(ReportJob).filter(ReportJob.id == job_id, ReportJob.user_id == user_id))
+    job = result.scalar_one_or_none()
+    if job is None:
+        raise HTTPException(status_code=404, detail="Report job not found or you don't have permission")
+    return job
+
+@router.post("/jobs", status_code=202, summary="Фоновое формирование отчета")
+async def create_report_job(db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    try:
+        job = ReportJob(id=uuid.uuid4().hex, user_id=user.id, status="pending", created_at=datetime.datetime.utcnow())
+        db.add(job)
+        await db.commit()
+        # В eager-режиме задача выполняется синхронно и запускает свой event loop,
+        # поэтому ставим её из пула потоков, а не из текущего цикла
+        await run_in_threadpool(generate_report_task.delay, job.id)
+        await db.refresh(job)
+        return job_response(job)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/jobs/{job_id}", summary="Статус фонового отчета")
+async def get_report_job(job_id: str, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    return job_response(await get_user_job(db, job_id, user.id))
+
+@router.get("/jobs/{job_id}/download/{filename}", summary="Скачивание фонового отчета")
+async def download_report_job(job_id: str, filename: str, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    job = await get_user_job(db, job_id, user.id)
+    if filename not in REPORT_FILES:
+        raise HTTPException(status_code=404, detail="File not found")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail="Report is not ready yet")
+    path = job_path(job.id, filename)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="File not found")
+    return FileResponse(path, media_type=REPORT_FILES[filename], filename=filename)
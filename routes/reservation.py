@@ -0,0 +1,158 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update
+from backend.database import get_db
+from backend.models import Stock, StockReservation, Sale, Product
+from backend.cache import bump_data_version
+from backend.events import stock_change, publish_stock_changes
+from backend.rollup import apply_sales_rollup
+from backend.reservations import release_reserved
+from backend import ledger
+from backend.ledger import movement, record_movements
+from dependencies import get_current_user
+from routes.sale import raise_stock_error, sync_stock_quantity
+from tasks import send_stock_alert_email_task
+from config import RESERVATION_TTL_SECONDS, RESERVATION_TTL_MAX_SECONDS, logger
+from typing import Optional
+from pydantic import BaseModel, conint
+import datetime
+
+router = APIRouter()
+
+class ReservationCreate(BaseModel):
+    product_id: int
+    quantity: int
+    ttl_seconds: Optional[conint(gt=0, le=RESERVATION_TTL_MAX_SECONDS)] = None
+
+def reservation_response(reservation: StockReservation):
+    return {
+        "id": reservation.id,
+        "product_id": reservation.product_id,
+        "quantity": reservation.quantity,
+        "status": reservation.status,
+        "expires_at": reservation.expires_at,
+        "sale_id": reservation.sale_id
+    }
+
+async def close_reservation(db: AsyncSession, reservation_id: int, user_id: int, status: str):
+    # Закрыть можно только активный резерв; условный UPDATE не даёт подтвердить
+    # и снять один резерв одновременно (или после того, как его снял экспайрер)
+    result = await db.execute(
+        update(StockReservation)
+        .where(
+            StockReservation.id == reservation_id,
+            StockReservation.user_id == user_id,
+            StockReservation.status == "active",
+            StockReservation.expires_at > datetime.datetime.utcnow()
+        )
+        .values(status=status)
+        .returning(StockReservation.product_id, StockReservation.quantity)
+        .execution_options(synchronize_session=False)
+    )
+    row = result.first()
+    if row is None:
+        raise HTTPException(status_code=409, detail="Reservation not found, expired or already closed")
+    return row
+
+@router.get("/available/{product_id}", summary="Доступный остаток товара")
+async def get_available(product_id: int, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    result = await db.execute(
+        select(Stock.quantity, Stock.reserved).filter(Stock.product_id == product_id, Stock.user_id == user.id)
+    )
+    row = result.first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Product not found in stock or you don't have permission")
+    return {"product_id": product_id, "quantity": row.quantity, "reserved": row.reserved, "available": row.quantity - row.reserved}
+
+@router.post("", status_code=201, summary="Резервирование товара")
+async def create_reservation(data: ReservationCreate, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    try:
+        if data.quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be positive")
+        result = await db.execute(
+            update(Stock)
+            .where(
+                Stock.product_id == data.product_id,
+                Stock.user_id == user.id,
+                Stock.quantity - Stock.reserved >= data.quantity
+            )
+            .values(reserved=Stock.reserved + data.quantity)
+            .returning(Stock.id)
+            .execution_options(synchronize_session=False)
+        )
+        if result.first() is None:
+            await db.rollback()
+            await raise_stock_error(db, user.id, data.product_id, data.quantity)
+        ttl_seconds = RESERVATION_TTL_SECONDS if data.ttl_seconds is None else data.ttl_seconds
+        reservation = StockReservation(
+            user_id=user.id,
+            product_id=data.product_id,
+            quantity=data.quantity,
+            status="active",
+            expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl_seconds)
+        )
+        db.add(reservation)
+        await db.commit()
+        return reservation_response(reservation)
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/{reservation_id}/confirm", summary="Подтверждение резерва в продажу")
+async def confirm_reservation(reservation_id: int, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    try:
+        reserved = await close_reservation(db, reservation_id, user.id, "confirmed")
+        # Товар уже удержан, поэтому списание безусловное: уменьшаем и остаток, и резерв
+        result = await db.execute(
+            update(Stock)
+            .where(Stock.product_id == reserved.product_id, Stock.user_id == user.id, Product.id == Stock.product_id)
+            .values(quantity=Stock.quantity - reserved.quantity, reserved=Stock.reserved - reserved.quantity)
+            .returning(Stock.id, Stock.quantity, Stock.minimum_quantity, Product.name, Product.price)
+            .execution_options(synchronize_session=False)
+        )
+        row = result.first()
+        if row is None:
+            # Строку остатка удалили, пока резерв был активен
+            raise HTTPException(status_code=404, detail="Product not found in stock or you don't have permission")
+        sync_stock_quantity(db, row.id, row.quantity)
+        total_price = row.price * reserved.quantity
+        sale = Sale(product_id=reserved.product_id, quantity=reserved.quantity, total_price=total_price, user_id=user.id, date_sold=datetime.datetime.utcnow())
+        db.add(sale)
+        await db.flush()
+        await db.execute(
+            update(StockReservation)
+            .where(StockReservation.id == reservation_id)
+            .values(sale_id=sale.id)
+            .execution_options(synchronize_session=False)
+        )
+        await record_movements(db, [movement(user.id, reserved.product_id, ledger.SALE, -reserved.quantity, row.quantity, sale.id, sale.date_sold)])
+        await apply_sales_rollup(db, user.id, [(reserved.product_id, sale.date_sold, reserved.quantity, total_price)])
+        await db.commit()
+        await bump_data_version(user.id)
+        await publish_stock_changes(user.id, [stock_change(row.id, row.quantity, row.minimum_quantity)])
+        logger.info(f"Резерв {reservation_id} подтверждён продажей {sale.id}, остаток: {row.quantity}")
+        if row.quantity < row.minimum_quantity:
+            send_stock_alert_email_task.delay(user.email, row.name, row.quantity, row.minimum_quantity)
+        return {"reservation_id": reservation_id, "status": "confirmed", "sale_id": sale.id, "total_price": total_price}
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/{reservation_id}/release", summary="Снятие резерва")
+async def release_reservation(reservation_id: int, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    try:
+        reserved = await close_reservation(db, reservation_id, user.id, "released")
+        await release_reserved(db, [(user.id, reserved.product_id, reserved.quantity)])
+        await db.commit()
+        return {"reservation_id": reservation_id, "status": "released"}
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,32 +1,280 @@
-from fastapi import APIRouter, Depends, Form, Request, HTTPException
+from fastapi import APIRouter, Depends, Form, Request, HTTPException, UploadFile, File, Query
 from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, insert, values, column, tuple_, func, Integer, and_, or_
+from sqlalchemy.orm.attributes import set_committed_value
 from backend.database import get_db
 from backend.models import Sale, Product, Stock
+from backend.rollup import apply_sales_rollup
+from backend import ledger
+from backend.ledger import movement, record_movements
+from backend.cache import bump_data_version
+from backend.ownership import load_owned
+from backend.events import stock_change, publish_stock_changes
 from dependencies import get_current_user
 from tasks import send_stock_alert_email_task
 from config import logger
+from typing import List, Optional
+from urllib.parse import urlencode
+from pydantic import BaseModel
+import base64
+import csv
+import io
 import datetime
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 
+SALES_PAGE_SIZE = 50
+SALES_PAGE_SIZE_MAX = 500
+
+class SaleLine(BaseModel):
+    product_id: int
+    quantity: int
+
+async def decrement_stock(db: AsyncSession, user_id: int, product_id: int, quantity: int):
+    # Условие quantity - reserved >= :n проверяет сама база под блокировкой строки,
+    # поэтому параллельные продажи не уходят в минус и не трогают резерв.
+    # None - списать нельзя.
+    result = await db.execute(
+        update(Stock)
+        .where(
+            Stock.product_id == product_id,
+            Stock.user_id == user_id,
+            Stock.quantity - Stock.reserved >= quantity,
+            Product.id == Stock.product_id,
+            Product.user_id == user_id
+        )
+        .values(quantity=Stock.quantity - quantity)
+        .returning(Stock.id, Stock.quantity, Stock.minimum_quantity, Product.name, Product.price)
+        .execution_options(synchronize_session=False)
+    )
+    row = result.first()
+    if row is not None:
+        sync_stock_quantity(db, row.id, row.quantity)
+    return row
+
+async def increment_stock(db: AsyncSession, user_id: int, product_id: int, quantity: int):
+    # Возврат товара на склад тем же атомарным UPDATE; None - строки остатка нет
+    result = await db.execute(
+        update(Stock)
+        .where(Stock.product_id == product_id, Stock.user_id == user_id, Product.id == Stock.product_id)
+        .values(quantity=Stock.quantity + quantity)
+        .returning(Stock.id, Stock.quantity, Stock.minimum_quantity, Product.name)
+        .execution_options(synchronize_session=False)
+    )
+    row = result.first()
+    if row is not None:
+        sync_stock_quantity(db, row.id, row.quantity)
+    return row
+
+def sync_stock_quantity(db: AsyncSession, stock_id: int, quantity: int):
+    # Обновляем уже загруженный в сессию Stock без лишнего SELECT
+    stock = db.identity_map.get(db.identity_key(Stock, stock_id))
+    if stock is not None:
+        set_committed_value(stock, "quantity", quantity)
+
+async def raise_stock_error(db: AsyncSession, user_id: int, product_id: int, quantity: int):
+    # Выясняем причину неудачного списания, только на холодном пути
+    result = await db.execute(
+        select(Product.id, Stock.quantity)
+        .outerjoin(Stock, (Stock.product_id == Product.id) & (Stock.user_id == user_id))
+        .filter(Product.id == product_id, Product.user_id == user_id)
+    )
+    row = result.first()
+    if row is None:
+        logger.error(f"Продукт не найден: product_id={product_id}, user_id={user_id}")
+        raise HTTPException(status_code=404, detail="Product not found or you don't have permission")
+    if row.quantity is None:
+        logger.error(f"Товар не найден на складе: product_id={product_id}, user_id={user_id}")
+        raise HTTPException(status_code=404, detail="Product not found in stock or you don't have permission")
+    logger.error(f"Недостаточно товара на складе: stock_quantity={row.quantity}, requested={quantity}")
+    raise HTTPException(status_code=400, detail="Not enough stock available")
+
+async def record_sales_batch(db: AsyncSession, user_id: int, lines):
+    # lines - список пар (номер строки, SaleLine). Все продажи пакета пишутся
+    # одной транзакцией: проверка владения, блокировка остатков, одно UPDATE
+    # по VALUES и один executemany INSERT. Коммит делает вызывающий код.
+    results = {number: {"line": number, "product_id": line.product_id, "quantity": line.quantity, "status": "error", "error": None} for number, line in lines}
+    product_ids = {line.product_id for _, line in lines}
+    if not product_ids:
+        return results, []
+    products = {
+        row.id: row for row in (await db.execute(
+            select(Product.id, Product.name, Product.price)
+            .filter(Product.id.in_(product_ids), Product.user_id == user_id)
+        )).all()
+    }
+    stocks = {
+        row.product_id: row for row in (await db.execute(
+            select(Stock.id, Stock.product_id, Stock.quantity, Stock.reserved, Stock.minimum_quantity)
+            .filter(Stock.product_id.in_(products.keys()), Stock.user_id == user_id)
+            .with_for_update()
+        )).all()
+    } if products else {}
+    available = {product_id: row.quantity for product_id, row in stocks.items()}
+    sold = {}
+    new_sales = []
+    balances = []
+    date_sold = datetime.datetime.utcnow()
+    for number, line in lines:
+        result = results[number]
+        if line.quantity <= 0:
+            result["error"] = "Quantity must be positive"
+        elif line.product_id not in products:
+            result["error"] = "Product not found or you don't have permission"
+        elif line.product_id not in available:
+            result["error"] = "Product not found in stock or you don't have permission"
+        elif available[line.product_id] - stocks[line.product_id].reserved < line.quantity:
+            result["error"] = "Not enough stock available"
+        else:
+            available[line.product_id] -= line.quantity
+            sold[line.product_id] = sold.get(line.product_id, 0) + line.quantity
+            balances.append(available[line.product_id])
+            new_sales.append({
+                "product_id": line.product_id,
+                "quantity": line.quantity,
+                "total_price": products[line.product_id].price * line.quantity,
+                "date_sold": date_sold,
+                "user_id": user_id
+            })
+            result["status"] = "ok"
+    if not new_sales:
+        return results, []
+    decrements = values(
+        column("product_id", Integer), column("quantity", Integer), name="decrements"
+    ).data(list(sold.items()))
+    await db.execute(
+        update(Stock)
+        .where(Stock.product_id == decrements.c.product_id, Stock.user_id == user_id)
+        .values(quantity=Stock.quantity - decrements.c.quantity)
+        .execution_options(synchronize_session=False)
+    )
+    # id продаж берём из последовательности заранее: executemany не возвращает
+    # их, а журналу движений нужна ссылка на каждую продажу
+    sale_ids = (await db.execute(
+        select(func.nextval("sales_id_seq")).select_from(func.generate_series(1, len(new_sales)))
+    )).scalars().all()
+    for sale, sale_id in zip(new_sales, sale_ids):
+        sale["id"] = sale_id
+    await db.execute(insert(Sale), new_sales)
+    await record_movements(db, (
+        movement(user_id, sale["product_id"], ledger.SALE, -sale["quantity"], balance, sale["id"], date_sold)
+        for sale, balance in zip(new_sales, balances)
+    ))
+    await apply_sales_rollup(db, user_id, ((sale["product_id"], sale["date_sold"], sale["quantity"], sale["total_price"]) for sale in new_sales))
+    touched = []
+    for product_id in sold:
+        stock = stocks[product_id]
+        sync_stock_quantity(db, stock.id, available[product_id])
+        touched.append((stock.id, products[product_id].name, available[product_id], stock.minimum_quantity))
+    return results, touched
+
+def parse_sales_csv(content: bytes):
+    # Ожидаются колонки product_id и quantity; строка 1 - заголовок
+    lines = []
+    errors = {}
+    reader = csv.DictReader(io.StringIO(content.decode("utf-8-sig")))
+    for number, row in enumerate(reader, start=2):
+        try:
+            lines.append((number, SaleLine(product_id=int(row["product_id"]), quantity=int(row["quantity"]))))
+        except (KeyError, TypeError, ValueError):
+            errors[number] = {"line": number, "product_id": row.get("product_id"), "quantity": row.get("quantity"), "status": "error", "error": "Invalid product_id or quantity"}
+    return lines, errors
+
+async def bulk_sales_response(db: AsyncSession, user, lines, errors=None):
+    logger.info(f"Пакетная загрузка продаж: {len(lines)} строк, user_id={user.id}")
+    results, touched = await record_sales_batch(db, user.id, lines)
+    await db.commit()
+    await bump_data_version(user.id)
+    await publish_stock_changes(user.id, [stock_change(stock_id, quantity, minimum_quantity) for stock_id, _, quantity, minimum_quantity in touched])
+    results.update(errors or {})
+    for _, product_name, quantity, minimum_quantity in touched:
+        if quantity < minimum_quantity:
+            send_stock_alert_email_task.delay(user.email, product_name, quantity, minimum_quantity)
+    results = [results[number] for number in sorted(results)]
+    created = sum(1 for result in results if result["status"] == "ok")
+    logger.info(f"Пакетная загрузка завершена: создано {created}, ошибок {len(results) - created}")
+    return {"created": created, "failed": len(results) - created, "results": results}
+
+def encode_cursor(date_sold: Optional[datetime.datetime], sale_id: int) -> str:
+    # date_sold может быть пустым у старых и импортированных продаж
+    value = date_sold.isoformat() if date_sold else ""
+    return base64.urlsafe_b64encode(f"{value}|{sale_id}".encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        date_sold, sale_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return (datetime.datetime.fromisoformat(date_sold) if date_sold else None), int(sale_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def after_cursor(cursor: str):
+    # Порядок date_sold DESC, id DESC: продажи без даты идут первыми (NULL в начале),
+    # как и при обратном проходе индекса, за ними - все датированные
+    date_sold, sale_id = decode_cursor(cursor)
+    if date_sold is None:
+        return or_(and_(Sale.date_sold.is_(None), Sale.id < sale_id), Sale.date_sold.isnot(None))
+    return tuple_(Sale.date_sold, Sale.id) < tuple_(date_sold, sale_id)
+
+def parse_date(value: Optional[str]):
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+
 @router.get("", summary="Список продаж")
-async def get_sales(request: Request, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+async def get_sales(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(SALES_PAGE_SIZE, ge=1, le=SALES_PAGE_SIZE_MAX),
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    product_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_db),
+    user=Depends(get_current_user)
+):
     try:
-        result = await db.execute(select(Sale).filter(Sale.user_id == user.id))
+        # Keyset-пагинация по (date_sold, id) на индексе ix_sales_user_date_id:
+        # следующая страница стоит одинаково на любой глубине, в отличие от OFFSET
+        query = select(Sale).filter(Sale.user_id == user.id)
+        start, end = parse_date(date_from), parse_date(date_to)
+        if start:
+            query = query.filter(Sale.date_sold >= start)
+        if end:
+            query = query.filter(Sale.date_sold < end + datetime.timedelta(days=1))
+        if product_id:
+            query = query.filter(Sale.product_id == product_id)
+        if cursor:
+            query = query.filter(after_cursor(cursor))
+        result = await db.execute(query.order_by(Sale.date_sold.desc(), Sale.id.desc()).limit(limit + 1))
         sales = result.scalars().all()
-        return templates.TemplateResponse("sales.html", {"request": request, "sales": sales})
+        next_url = None
+        if len(sales) > limit:
+            sales = sales[:limit]
+            params = {"date_from": date_from, "date_to": date_to, "product_id": product_id, "limit": limit}
+            params = {key: value for key, value in params.items() if value}
+            params["cursor"] = encode_cursor(sales[-1].date_sold, sales[-1].id)
+            next_url = f"/sales?{urlencode(params)}"
+        return templates.TemplateResponse("sales.html", {
+            "request": request,
+            "sales": sales,
+            "next_url": next_url,
+            "date_from": date_from or "",
+            "date_to": date_to or "",
+            "product_id": product_id or ""
+        })
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
 
 @router.get("/create", summary="Форма создания продажи")
-async def create_sale(request: Request, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+async def create_sale(request: Request, user=Depends(get_current_user)):
     try:
-        products = (await db.execute(select(Product).filter(Product.user_id == user.id))).scalars().all()
-        return templates.TemplateResponse("create_sale.html", {"request": request, "products": products})
+        # Товары подгружает автодополнение через /product/api/search
+        return templates.TemplateResponse("create_sale.html", {"request": request})
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
 
@@ -40,33 +288,33 @@ async def create_sale_post(
 ):
     try:
         logger.info(f"Начало создания продажи: product_id={product_id}, quantity={quantity}, user_id={user.id}")
-        result_product = await db.execute(select(Product).filter(Product.id == product_id, Product.user_id == user.id))
-        product = result_product.scalar_one_or_none()
-        if not product:
-            logger.error(f"Продукт не найден: product_id={product_id}, user_id={user.id}")
-            raise HTTPException(status_code=404, detail="Product not found or you don't have permission")
-        result_stock = await db.execute(select(Stock).filter(Stock.product_id == product_id, Stock.user_id == user.id))
-        product_on_stock = result_stock.scalar_one_or_none()
-        if not product_on_stock:
-            logger.error(f"Товар не найден на складе: product_id={product_id}, user_id={user.id}")
-            raise HTTPException(status_code=404, detail="Product not found in stock or you don't have permission")
-        if product_on_stock.quantity < quantity:
-            logger.error(f"Недостаточно товара на складе: stock_quantity={product_on_stock.quantity}, requested={quantity}")
-            raise HTTPException(status_code=400, detail="Not enough stock available")
-        total_price = product.price * quantity
+        if quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be positive")
+        row = await decrement_stock(db, user.id, product_id, quantity)
+        if row is None:
+            await db.rollback()
+            await raise_stock_error(db, user.id, product_id, quantity)
+        total_price = row.price * quantity
         new_sale = Sale(product_id=product_id, quantity=quantity, total_price=total_price, user_id=user.id, date_sold=datetime.datetime.utcnow())
         db.add(new_sale)
-        product_on_stock.quantity -= quantity
+        await db.flush()
+        await record_movements(db, [movement(user.id, product_id, ledger.SALE, -quantity, row.quantity, new_sale.id, new_sale.date_sold)])
+        await apply_sales_rollup(db, user.id, [(product_id, new_sale.date_sold, quantity, total_price)])
         await db.commit()
-        await db.refresh(product_on_stock)
-        logger.info(f"Продажа создана, остаток: {product_on_stock.quantity}")
-        if product_on_stock.quantity < 10:
-            logger.info(f"Остаток меньше 10, отправка email через Celery на {user.email}")
-            send_stock_alert_email_task.delay(user.email, product.name, product_on_stock.quantity)
+        await bump_data_version(user.id)
+        await publish_stock_changes(user.id, [stock_change(row.id, row.quantity, row.minimum_quantity)])
+        logger.info(f"Продажа создана, остаток: {row.quantity}")
+        if row.quantity < row.minimum_quantity:
+            logger.info(f"Остаток меньше {row.minimum_quantity}, отправка email через Celery на {user.email}")
+            send_stock_alert_email_task.delay(user.email, row.name, row.quantity, row.minimum_quantity)
         else:
-            logger.info(f"Остаток {product_on_stock.quantity} >= 10, email не отправляется")
+            logger.info(f"Остаток {row.quantity} >= {row.minimum_quantity}, email не отправляется")
         return RedirectResponse(url="/sales", status_code=303)
+    except HTTPException as e:
+        await db.rollback()
+        return templates.TemplateResponse("error.html", {"request": request, "status_code": e.status_code, "detail": e.detail}, status_code=e.status_code)
     except Exception as e:
+        await db.rollback()
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
 
 @router.get("/edit/{sale_id}", summary="Форма редактирования продажи")
@@ -91,46 +339,43 @@ async def edit_sale_post(
     user=Depends(get_current_user)
 ):
     try:
-        result_sale = await db.execute(select(Sale).filter(Sale.id == sale_id, Sale.user_id == user.id))
-        sale = result_sale.scalar_one_or_none()
-        if sale is None:
-            raise HTTPException(status_code=404, detail="Sale not found or you don't have permission")
-        result_old_stock = await db.execute(select(Stock).filter(Stock.product_id == sale.product_id, Stock.user_id == user.id))
-        old_product_on_stock = result_old_stock.scalar_one_or_none()
-        result_new_stock = await db.execute(select(Stock).filter(Stock.product_id == product_id, Stock.user_id == user.id))
-        new_product_on_stock = result_new_stock.scalar_one_or_none()
-        if not new_product_on_stock:
-            raise HTTPException(status_code=404, detail="New product not found in stock or you don't have permission")
-        result_product = await db.execute(select(Product).filter(Product.id == product_id, Product.user_id == user.id))
-        new_product = result_product.scalar_one_or_none()
-        if not new_product:
-            raise HTTPException(status_code=404, detail="New product not found or you don't have permission")
-        quantity_difference = quantity - sale.quantity
-        if quantity_difference > 0 and new_product_on_stock.quantity < quantity_difference:
-            raise HTTPException(status_code=400, detail="Not enough stock available for new product")
-        if old_product_on_stock:
-            old_product_on_stock.quantity += sale.quantity
-        if quantity_difference > 0:
-            new_product_on_stock.quantity -= quantity_difference
-        elif quantity_difference < 0:
-            if old_product_on_stock:
-                old_product_on_stock.quantity += abs(quantity_difference)
-        total_price = new_product.price * quantity
+        if quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be positive")
+        sale = await load_owned(db, user.id, Sale, sale_id, [(Product, product_id)])
+        # Сначала возвращаем старую продажу на склад, затем списываем новую теми же
+        # атомарными UPDATE, что и при создании: ручной арифметики над остатками нет
+        restored = await increment_stock(db, user.id, sale.product_id, sale.quantity)
+        row = await decrement_stock(db, user.id, product_id, quantity)
+        if row is None:
+            await db.rollback()
+            await raise_stock_error(db, user.id, product_id, quantity)
+        total_price = row.price * quantity
+        now = datetime.datetime.utcnow()
+        movements = [movement(user.id, product_id, ledger.SALE, -quantity, row.quantity, sale.id, now)]
+        if restored is not None:
+            movements.insert(0, movement(user.id, sale.product_id, ledger.REVERSAL, sale.quantity, restored.quantity, sale.id, now))
+        await record_movements(db, movements)
+        await apply_sales_rollup(db, user.id, [
+            (sale.product_id, sale.date_sold, -sale.quantity, -sale.total_price),
+            (product_id, sale.date_sold, quantity, total_price)
+        ])
+        old_product_id = sale.product_id
         sale.product_id = product_id
         sale.quantity = quantity
         sale.total_price = total_price
         await db.commit()
-        if old_product_on_stock:
-            await db.refresh(old_product_on_stock)
-        await db.refresh(new_product_on_stock)
-        await db.refresh(sale)
-        if new_product_on_stock.quantity < 10:
-            send_stock_alert_email_task.delay(user.email, new_product.name, new_product_on_stock.quantity)
-        if old_product_on_stock and old_product_on_stock.quantity < 10 and old_product_on_stock.product_id != new_product_on_stock.product_id:
-            old_product = (await db.execute(select(Product).filter(Product.id == old_product_on_stock.product_id))).scalar_one()
-            send_stock_alert_email_task.delay(user.email, old_product.name, old_product_on_stock.quantity)
+        await bump_data_version(user.id)
+        changes = [stock_change(row.id, row.quantity, row.minimum_quantity)]
+        if restored is not None and restored.id != row.id:
+            changes.insert(0, stock_change(restored.id, restored.quantity, restored.minimum_quantity))
+        await publish_stock_changes(user.id, changes)
+        if row.quantity < row.minimum_quantity:
+            send_stock_alert_email_task.delay(user.email, row.name, row.quantity, row.minimum_quantity)
+        if restored is not None and restored.quantity < restored.minimum_quantity and old_product_id != product_id:
+            send_stock_alert_email_task.delay(user.email, restored.name, restored.quantity, restored.minimum_quantity)
         return RedirectResponse(url="/sales", status_code=303)
     except Exception as e:
+        await db.rollback()
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
 
 @router.get("/delete/{sale_id}", summary="Удаление продажи")
@@ -141,17 +386,34 @@ async def delete_sale(
     user=Depends(get_current_user)
 ):
     try:
-        result_sale = await db.execute(select(Sale).filter(Sale.id == sale_id, Sale.user_id == user.id))
-        sale = result_sale.scalar_one_or_none()
-        if sale is None:
-            raise HTTPException(status_code=404, detail="Sale not found or you don't have permission")
-        result_stock = await db.execute(select(Stock).filter(Stock.product_id == sale.product_id, Stock.user_id == user.id))
-        product_on_stock = result_stock.scalar_one_or_none()
-        if product_on_stock is None:
+        sale = await load_owned(db, user.id, Sale, sale_id)
+        restored = await increment_stock(db, user.id, sale.product_id, sale.quantity)
+        if restored is None:
             raise HTTPException(status_code=404, detail="Product not found in stock or you don't have permission")
-        product_on_stock.quantity += sale.quantity
+        await record_movements(db, [movement(user.id, sale.product_id, ledger.REVERSAL, sale.quantity, restored.quantity, sale.id)])
+        await apply_sales_rollup(db, user.id, [(sale.product_id, sale.date_sold, -sale.quantity, -sale.total_price)])
         await db.delete(sale)
         await db.commit()
+        await bump_data_version(user.id)
+        await publish_stock_changes(user.id, [stock_change(restored.id, restored.quantity, restored.minimum_quantity)])
         return RedirectResponse(url="/sales", status_code=303)
     except Exception as e:
-        return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
\ No newline at end of file
+        await db.rollback()
+        return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
+
+@router.post("/bulk", summary="Пакетная загрузка продаж (JSON)")
+async def bulk_create_sales(lines: List[SaleLine], db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    try:
+        return await bulk_sales_response(db, user, list(enumerate(lines, start=1)))
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/bulk/csv", summary="Пакетная загрузка продаж (CSV)")
+async def bulk_create_sales_csv(file: UploadFile = File(...), db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    try:
+        lines, errors = parse_sales_csv(await file.read())
+        return await bulk_sales_response(db, user, lines, errors)
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,40 +1,167 @@
-from fastapi import APIRouter, Depends, Form, Request, HTTPException
-from fastapi.responses import RedirectResponse
+from fastapi import APIRouter, Depends, Form, Request, HTTPException, Query, UploadFile, File
+from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
+from sqlalchemy import select, tuple_, literal, func, Table, Column, MetaData, Integer
+from sqlalchemy.dialects.postgresql import insert
 from backend.database import get_db
-from backend.models import Stock, Product
+from backend.models import Stock, Product, ReorderSuggestion
+from backend.cache import bump_data_version
+from backend.ownership import load_owned
+from backend.uploads import read_table
+from backend.events import stock_events, stock_change, publish_stock_changes
+from backend import ledger
+from backend.ledger import movement, record_movements, stock_at, movements_between
 from dependencies import get_current_user
+from config import STOCK_EVENTS_KEEPALIVE_SECONDS
+from routes.sale import sync_stock_quantity
+from typing import Optional
+from urllib.parse import urlencode
+import asyncio
+import base64
+import datetime
+import json
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 
+STOCKS_PAGE_SIZE = 100
+IMPORT_BATCH_SIZE = 5000
+
+# Временная таблица для загрузки прихода через COPY, живёт до конца транзакции
+stock_import = Table(
+    "stock_import", MetaData(),
+    Column("line", Integer, nullable=False),
+    Column("product_id", Integer, nullable=False),
+    Column("quantity", Integer, nullable=False),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP"
+)
+STOCK_SORT_COLUMNS = {"name": Product.name, "quantity": Stock.quantity, "id": Stock.id}
+
+def encode_stock_cursor(value, stock_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, stock_id]).encode()).decode()
+
+def decode_stock_cursor(cursor: str):
+    try:
+        value, stock_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return value, int(stock_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @router.get("", summary="Список остатков")
-async def get_stocks(request: Request, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+async def get_stocks(
+    request: Request,
+    sort: str = Query("name", pattern="^(name|quantity|id)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    cursor: Optional[str] = None,
+    limit: int = Query(STOCKS_PAGE_SIZE, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db),
+    user=Depends(get_current_user)
+):
     try:
-        result = await db.execute(
-            select(Stock)
+        # Проекция только отображаемых колонок: без joinedload по всем связям
+        # и без сборки ORM-объектов в identity map. Страницы - по ключу (sort, id)
+        sort_column = STOCK_SORT_COLUMNS[sort]
+        query = (
+            select(Stock.id, Product.name.label("product_name"), Stock.quantity, Stock.minimum_quantity)
+            .join(Product, Product.id == Stock.product_id)
             .filter(Stock.user_id == user.id)
-            .options(
-                joinedload(Stock.product).joinedload(Product.manufacturer),
-                joinedload(Stock.product).joinedload(Product.counterparty),
-                joinedload(Stock.product).joinedload(Product.agreement),
-                joinedload(Stock.product).joinedload(Product.user),
-                joinedload(Stock.user)
+        )
+        if cursor:
+            key = tuple_(sort_column, Stock.id)
+            last = tuple_(*decode_stock_cursor(cursor))
+            query = query.filter(key < last if order == "desc" else key > last)
+        if order == "desc":
+            query = query.order_by(sort_column.desc(), Stock.id.desc())
+        else:
+            query = query.order_by(sort_column, Stock.id)
+        rows = (await db.execute(query.limit(limit + 1))).all()
+        # Рекомендации прогноза - отдельным запросом по первичному ключу только для строк страницы
+        suggestions = {}
+        if rows:
+            result = await db.execute(
+                select(ReorderSuggestion.stock_id, ReorderSuggestion.reorder_point, ReorderSuggestion.order_quantity, ReorderSuggestion.days_of_cover)
+                .filter(ReorderSuggestion.stock_id.in_([row.id for row in rows[:limit]]))
             )
+            suggestions = {row.stock_id: row for row in result}
+        next_url = None
+        if len(rows) > limit:
+            last_row = rows[limit - 1]
+            last_value = {"name": last_row.product_name, "quantity": last_row.quantity, "id": last_row.id}[sort]
+            params = {"sort": sort, "order": order, "limit": limit, "cursor": encode_stock_cursor(last_value, last_row.id)}
+            next_url = f"/stocks?{urlencode(params)}"
+        return templates.TemplateResponse("stocks.html", {
+            "request": request,
+            "stocks": rows[:limit],
+            "suggestions": suggestions,
+            "sort": sort,
+            "order": order,
+            "next_url": next_url
+        })
+    except Exception as e:
+        return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
+
+@router.get("/low", summary="Товары ниже минимального остатка")
+async def get_low_stocks(
+    request: Request,
+    after: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    format: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+    user=Depends(get_current_user)
+):
+    try:
+        # Условие совпадает с предикатом ix_stock_low, поэтому читается только частичный индекс
+        query = (
+            select(Stock.id, Stock.product_id, Product.name.label("product_name"), Stock.quantity, Stock.minimum_quantity)
+            .join(Product, Product.id == Stock.product_id)
+            .filter(Stock.user_id == user.id, Stock.quantity < Stock.minimum_quantity)
         )
-        stocks = result.scalars().all()
-        return templates.TemplateResponse("stocks.html", {"request": request, "stocks": stocks})
+        if after:
+            query = query.filter(Stock.id > after)
+        rows = (await db.execute(query.order_by(Stock.id).limit(limit + 1))).all()
+        next_after = rows[limit - 1].id if len(rows) > limit else None
+        stocks = [row._asdict() for row in rows[:limit]]
+        if format == "json" or "application/json" in request.headers.get("accept", ""):
+            return {"items": stocks, "next_after": next_after}
+        return templates.TemplateResponse("low_stocks.html", {
+            "request": request,
+            "stocks": stocks,
+            "next_url": f"/stocks/low?after={next_after}&limit={limit}" if next_after else None
+        })
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
 
+@router.get("/events", summary="Изменения остатков в реальном времени (SSE)")
+async def stock_events_stream(user=Depends(get_current_user)):
+    # Клиент получает только изменённые строки; событие resync - очередь
+    # переполнилась и страницу нужно перечитать целиком
+    queue = stock_events.subscribe(user.id)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    changes = await asyncio.wait_for(queue.get(), STOCK_EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if changes is None:
+                    yield "event: resync\ndata: {}\n\n"
+                else:
+                    yield f"event: stock\ndata: {json.dumps(changes)}\n\n"
+        finally:
+            stock_events.unsubscribe(user.id, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @router.get("/create", summary="Форма создания остатка")
-async def create_stock(request: Request, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+async def create_stock(request: Request, user=Depends(get_current_user)):
     try:
-        products = (await db.execute(select(Product).filter(Product.user_id == user.id))).scalars().all()
-        return templates.TemplateResponse("create_stock.html", {"request": request, "products": products})
+        # Товары подгружает автодополнение через /product/api/search
+        return templates.TemplateResponse("create_stock.html", {"request": request})
     except Exception as e:
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
 
@@ -47,20 +174,29 @@ async def create_stock_post(
     user=Depends(get_current_user)
 ):
     try:
-        result_product = await db.execute(select(Product).filter(Product.id == product_id, Product.user_id == user.id))
-        product = result_product.scalar_one_or_none()
-        if not product:
+        if quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantity must be positive")
+        # Один INSERT ... SELECT ... ON CONFLICT: проверка владения товаром и
+        # приход без гонки между параллельными поступлениями одного товара
+        source = select(Product.id, literal(quantity, Integer), literal(user.id, Integer)).filter(
+            Product.id == product_id, Product.user_id == user.id
+        )
+        stmt = insert(Stock).from_select(["product_id", "quantity", "user_id"], source)
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_stock_product_user",
+            set_={"quantity": Stock.quantity + stmt.excluded.quantity}
+        ).returning(Stock.id, Stock.quantity, Stock.minimum_quantity)
+        row = (await db.execute(stmt)).first()
+        if row is None:
             raise HTTPException(status_code=404, detail="Product not found or you don't have permission")
-        result_stock = await db.execute(select(Stock).filter(Stock.product_id == product_id, Stock.user_id == user.id))
-        stock = result_stock.scalar_one_or_none()
-        if stock:
-            stock.quantity += quantity
-        else:
-            new_stock = Stock(product_id=product_id, quantity=quantity, user_id=user.id)
-            db.add(new_stock)
+        sync_stock_quantity(db, row.id, row.quantity)
+        await record_movements(db, [movement(user.id, product_id, ledger.RECEIPT, quantity, row.quantity)])
         await db.commit()
+        await bump_data_version(user.id)
+        await publish_stock_changes(user.id, [stock_change(row.id, row.quantity, row.minimum_quantity)])
         return RedirectResponse(url="/stocks", status_code=303)
     except Exception as e:
+        await db.rollback()
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
 
 @router.get("/edit/{stock_id}", summary="Форма редактирования остатка")
@@ -85,20 +221,30 @@ async def edit_stock_post(
     user=Depends(get_current_user)
 ):
     try:
-        result = await db.execute(select(Stock).filter(Stock.id == stock_id, Stock.user_id == user.id))
-        stock = result.scalar_one_or_none()
-        if stock is None:
-            raise HTTPException(status_code=404, detail="Stock not found or you don't have permission")
-        result_product = await db.execute(select(Product).filter(Product.id == product_id, Product.user_id == user.id))
-        product = result_product.scalar_one_or_none()
-        if not product:
-            raise HTTPException(status_code=404, detail="Product not found or you don't have permission")
+        # Блокировка не даёт новому резерву проскочить между проверкой и записью
+        stock = await load_owned(db, user.id, Stock, stock_id, [(Product, product_id)], lock=True)
+        if stock.reserved and stock.product_id != product_id:
+            raise HTTPException(status_code=409, detail="Stock has active reservations, the product cannot be changed")
+        if quantity < stock.reserved:
+            raise HTTPException(status_code=400, detail=f"Quantity cannot be less than reserved ({stock.reserved})")
+        product_name = None
         if stock.product_id != product_id:
+            # Название нужно только подписчикам /stocks/events, и только при смене товара
+            product_name = (await db.execute(select(Product.name).filter(Product.id == product_id))).scalar_one()
+            await record_movements(db, [
+                movement(user.id, stock.product_id, ledger.ADJUSTMENT, -stock.quantity, 0),
+                movement(user.id, product_id, ledger.ADJUSTMENT, quantity, quantity)
+            ])
             stock.product_id = product_id
+        elif stock.quantity != quantity:
+            await record_movements(db, [movement(user.id, product_id, ledger.ADJUSTMENT, quantity - stock.quantity, quantity)])
         stock.quantity = quantity
         await db.commit()
+        await bump_data_version(user.id)
+        await publish_stock_changes(user.id, [stock_change(stock.id, stock.quantity, stock.minimum_quantity, product_name)])
         return RedirectResponse(url="/stocks", status_code=303)
     except Exception as e:
+        await db.rollback()
         return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
 
 @router.get("/delete/{stock_id}", summary="Удаление остатка")
@@ -109,12 +255,134 @@ async def delete_stock(
     user=Depends(get_current_user)
 ):
     try:
-        result = await db.execute(select(Stock).filter(Stock.id == stock_id, Stock.user_id == user.id))
-        stock = result.scalar_one_or_none()
-        if stock is None:
-            raise HTTPException(status_code=404, detail="Stock not found or you don't have permission")
+        stock = await load_owned(db, user.id, Stock, stock_id, lock=True)
+        if stock.reserved:
+            raise HTTPException(status_code=409, detail="Stock has active reservations and cannot be deleted")
+        await record_movements(db, [movement(user.id, stock.product_id, ledger.ADJUSTMENT, -stock.quantity, 0)])
         await db.delete(stock)
         await db.commit()
+        await bump_data_version(user.id)
+        await publish_stock_changes(user.id, [stock_change(stock_id, deleted=True)])
         return RedirectResponse(url="/stocks", status_code=303)
     except Exception as e:
-        return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
\ No newline at end of file
+        await db.rollback()
+        return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
+
+def parse_moment(value: Optional[str], default: datetime.datetime) -> datetime.datetime:
+    if not value:
+        return default
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS")
+
+@router.get("/balance/{product_id}", summary="Остаток товара на момент времени")
+async def get_stock_balance(product_id: int, at: Optional[str] = None, db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    moment = parse_moment(at, datetime.datetime.utcnow())
+    return {"product_id": product_id, "at": moment, "quantity": await stock_at(db, user.id, product_id, moment)}
+
+@router.get("/movements/{product_id}", summary="Движения товара за период")
+async def get_stock_movements(
+    product_id: int,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    db: AsyncSession = Depends(get_db),
+    user=Depends(get_current_user)
+):
+    end = parse_moment(date_to, datetime.datetime.utcnow())
+    start = parse_moment(date_from, end - datetime.timedelta(days=30))
+    movements = await movements_between(db, user.id, product_id, start, end, limit)
+    return [
+        {
+            "id": m.id,
+            "kind": m.kind,
+            "quantity": m.quantity,
+            "balance_after": m.balance_after,
+            "sale_id": m.sale_id,
+            "created_at": m.created_at
+        }
+        for m in movements
+    ]
+
+def read_receipt_rows(upload: UploadFile):
+    columns, rows = read_table(upload, ["product_id", "quantity"])
+    product_index, quantity_index = columns["product_id"], columns["quantity"]
+    for number, row in rows:
+        try:
+            product_id, quantity = int(row[product_index]), int(row[quantity_index])
+        except (IndexError, TypeError, ValueError):
+            yield number, None, "Invalid product_id or quantity"
+            continue
+        if quantity <= 0:
+            yield number, None, "Quantity must be positive"
+        else:
+            yield number, (number, product_id, quantity), None
+
+async def import_receipts(db: AsyncSession, user_id: int, upload: UploadFile):
+    conn = await db.connection()
+    await conn.run_sync(stock_import.create)
+    driver = (await conn.get_raw_connection()).driver_connection
+    errors = []
+    batch = []
+    lines = 0
+    for number, record, error in read_receipt_rows(upload):
+        if error:
+            errors.append({"line": number, "error": error})
+            continue
+        batch.append(record)
+        lines += 1
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await driver.copy_records_to_table("stock_import", records=batch, columns=["line", "product_id", "quantity"])
+            batch = []
+    if batch:
+        await driver.copy_records_to_table("stock_import", records=batch, columns=["line", "product_id", "quantity"])
+    rejected = len(errors)
+    # Владение проверяется одним соединением staging-таблицы с products
+    owned = (Product.id == stock_import.c.product_id) & (Product.user_id == user_id)
+    foreign = (await db.execute(
+        select(stock_import.c.line)
+        .select_from(stock_import.outerjoin(Product, owned))
+        .filter(Product.id.is_(None))
+        .order_by(stock_import.c.line)
+    )).scalars().all()
+    errors.extend({"line": line, "error": "Product not found or you don't have permission"} for line in foreign)
+    source = (
+        select(stock_import.c.product_id, func.sum(stock_import.c.quantity).label("quantity"), literal(user_id, Integer))
+        .select_from(stock_import.join(Product, owned))
+        .group_by(stock_import.c.product_id)
+    )
+    received = {row.product_id: row.quantity for row in await db.execute(source)}
+    stmt = insert(Stock).from_select(["product_id", "quantity", "user_id"], source)
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_stock_product_user",
+        set_={"quantity": Stock.quantity + stmt.excluded.quantity}
+    ).returning(Stock.id, Stock.product_id, Stock.quantity, Stock.minimum_quantity)
+    merged = (await db.execute(stmt)).all()
+    await record_movements(db, [movement(user_id, row.product_id, ledger.RECEIPT, received[row.product_id], row.quantity) for row in merged])
+    for row in merged:
+        sync_stock_quantity(db, row.id, row.quantity)
+    errors.sort(key=lambda error: error["line"])
+    changes = [stock_change(row.id, row.quantity, row.minimum_quantity) for row in merged]
+    return changes, {
+        "lines": lines + rejected,
+        "imported": lines - len(foreign),
+        "products_updated": len(merged),
+        "failed": len(errors),
+        "errors": errors
+    }
+
+@router.post("/import", summary="Загрузка прихода из CSV/XLSX")
+async def import_stock(file: UploadFile = File(...), db: AsyncSession = Depends(get_db), user=Depends(get_current_user)):
+    try:
+        changes, result = await import_receipts(db, user.id, file)
+        await db.commit()
+        await bump_data_version(user.id)
+        await publish_stock_changes(user.id, changes)
+        return result
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,6 +1,11 @@
+import asyncio
 import smtplib
 import ssl
 from email.mime.text import MIMEText
+from backend.ledger import compact
+from backend.report_jobs import run_report_job
+from backend.reservations import expire_reservations
+from backend.forecast import run_forecast
 from config import celery_app, EMAIL_HOST, EMAIL_PORT, EMAIL_USER, EMAIL_PASSWORD, EMAIL_FROM, logger
 
 def send_stock_alert_email(user_email: str, product_name: str, quantity: int, minimum_quantity: int = 10):
@@ -30,5 +35,21 @@ def send_stock_alert_email(user_email: str, product_name: str, quantity: int, mi
         raise
 
 @celery_app.task
-def send_stock_alert_email_task(user_email: str, product_name: str, quantity: int):
-    send_stock_alert_email(user_email, product_name, quantity)
\ No newline at end of file
+def send_stock_alert_email_task(user_email: str, product_name: str, quantity: int, minimum_quantity: int = 10):
+    send_stock_alert_email(user_email, product_name, quantity, minimum_quantity)
+
+@celery_app.task
+def generate_report_task(job_id: str):
+    asyncio.run(run_report_job(job_id))
+
+@celery_app.task
+def compact_stock_movements_task():
+    asyncio.run(compact())
+
+@celery_app.task
+def expire_reservations_task():
+    asyncio.run(expire_reservations())
+
+@celery_app.task
+def forecast_reorder_points_task():
+    asyncio.run(run_forecast())
@@ -1,14 +1,27 @@
 import pytest
 from httpx import AsyncClient
-from backend.database import get_db
+from backend.database import get_db, get_session_factory
 from main import app
-from backend.models import Base, User, Sale, Product, Stock, Manufacturer, Counterparty, Agreement
-from datetime import datetime
-from backend.auth import hash_password
+from backend.models import Base, User, Sale, Product, Stock, Manufacturer, Counterparty, Agreement, SalesDailyRollup, StockReservation, ReorderSuggestion, StockMovement
+from datetime import datetime, timedelta
+from backend.rollup import rebuild_user_rollups
+from backend.cache import LRUCache, report_cache
+from config import celery_app
+from backend.ledger import compact_movements
+from routes.sale import encode_cursor, after_cursor
+from backend.reservations import expire_batch
+from backend.forecast import compute_suggestions, forecast_user
+from backend.events import LocalStockEvents, stock_events
+from backend.reference import reference_cache
+from dependencies import user_cache, pwd_context, hash_password
+from passlib.hash import bcrypt
+from backend.throttle import LoginThrottle, MemoryTokenBuckets, login_throttle
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 import asyncio
-from sqlalchemy import select
+import json
+import numpy as np
+from sqlalchemy import select, update, event, func, text
 import pytest_asyncio
 
 pytestmark = pytest.mark.asyncio
@@ -45,6 +58,10 @@ async def client(db_session):
         return db_session
 
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_session_factory] = lambda: TestSessionLocal
+    # База пересоздаётся на каждый тест, закэшированные пользователи от прошлых тестов не годятся
+    user_cache.clear()
+    login_throttle.clear()
     async with AsyncClient(app=app, base_url="http://test") as async_client:
         yield async_client
     app.dependency_overrides.clear()
@@ -303,4 +320,634 @@ async def test_delete_sale(authenticated_client, db_session):
     deleted_sale = await db_session.execute(select(Sale).filter(Sale.id == sale.id))
     assert deleted_sale.scalar_one_or_none() is None
     updated_stock = await db_session.execute(select(Stock).filter(Stock.product_id == product.id))
-    assert updated_stock.scalar_one().quantity == 15
\ No newline at end of file
+    assert updated_stock.scalar_one().quantity == 15
+
+@pytest_asyncio.fixture
+async def stocked_product(authenticated_client, db_session):
+    client, user = authenticated_client
+    manufacturer = Manufacturer(name="Test Man", address="123 St", phone_number="12345", user_id=user.id)
+    counterparty = Counterparty(name="Test Counter", address="456 St", phone_number="67890", user_id=user.id)
+    db_session.add_all([manufacturer, counterparty])
+    await db_session.commit()
+    agreement = Agreement(
+        contract_number="A1",
+        date_signed=datetime.utcnow(),
+        counterparty_id=counterparty.id,
+        user_id=user.id
+    )
+    db_session.add(agreement)
+    await db_session.commit()
+    product = Product(
+        name="Test Product",
+        price=100.0,
+        manufacturer_id=manufacturer.id,
+        counterparty_id=counterparty.id,
+        agreement_id=agreement.id,
+        user_id=user.id
+    )
+    db_session.add(product)
+    await db_session.commit()
+    stock = Stock(product_id=product.id, quantity=20, user_id=user.id)
+    db_session.add(stock)
+    await db_session.commit()
+    return client, user, product, stock
+
+async def test_bulk_create_sales(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    response = await client.post("/sales/bulk", json=[
+        {"product_id": product.id, "quantity": 5},
+        {"product_id": product.id, "quantity": 30},
+        {"product_id": 999999, "quantity": 1},
+        {"product_id": product.id, "quantity": 10}
+    ])
+    assert response.status_code == 200
+    data = response.json()
+    assert data["created"] == 2
+    assert data["failed"] == 2
+    assert [r["status"] for r in data["results"]] == ["ok", "error", "error", "ok"]
+    assert data["results"][1]["error"] == "Not enough stock available"
+    sales = (await db_session.execute(select(Sale).filter(Sale.product_id == product.id))).scalars().all()
+    assert sorted(s.total_price for s in sales) == [500.0, 1000.0]
+    updated_stock = await db_session.execute(select(Stock).filter(Stock.product_id == product.id))
+    assert updated_stock.scalar_one().quantity == 5
+
+async def test_bulk_create_sales_csv(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    content = f"product_id,quantity\n{product.id},3\nabc,1\n".encode()
+    response = await client.post("/sales/bulk/csv", files={"file": ("sales.csv", content, "text/csv")})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["created"] == 1
+    assert data["results"][1] == {"line": 3, "product_id": "abc", "quantity": "1", "status": "error", "error": "Invalid product_id or quantity"}
+
+async def test_get_sales_keyset_pagination(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    db_session.add_all([
+        Sale(product_id=product.id, quantity=1, total_price=100.0, user_id=user.id, date_sold=datetime(2025, 1, day))
+        for day in range(1, 6)
+    ])
+    await db_session.commit()
+    response = await client.get("/sales", params={"limit": 2})
+    assert response.status_code == 200
+    assert "2025-01-05" in response.text and "2025-01-04" in response.text
+    assert "2025-01-03" not in response.text
+    assert "cursor=" in response.text
+    response = await client.get("/sales", params={"date_from": "2025-01-02", "date_to": "2025-01-02"})
+    assert "2025-01-02" in response.text
+    assert "2025-01-03" not in response.text
+
+async def test_sales_keyset_pagination_with_undated_sales(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    sales = [
+        Sale(product_id=product.id, quantity=1, total_price=100.0, user_id=user.id, date_sold=datetime(2025, 1, day))
+        for day in range(1, 5)
+    ]
+    db_session.add_all(sales)
+    await db_session.commit()
+    # NULL в date_sold - как у старых продаж; ORM при вставке подставил бы default
+    await db_session.execute(update(Sale).where(Sale.id.in_([sales[1].id, sales[3].id])).values(date_sold=None))
+    await db_session.commit()
+    response = await client.get("/sales", params={"limit": 1})
+    assert response.status_code == 200
+    assert "cursor=" in response.text
+    seen, cursor = [], None
+    while True:
+        query = select(Sale.id, Sale.date_sold).filter(Sale.user_id == user.id)
+        if cursor:
+            query = query.filter(after_cursor(cursor))
+        row = (await db_session.execute(query.order_by(Sale.date_sold.desc(), Sale.id.desc()).limit(1))).first()
+        if row is None:
+            break
+        seen.append(row.id)
+        cursor = encode_cursor(row.date_sold, row.id)
+    assert seen == [sales[3].id, sales[1].id, sales[2].id, sales[0].id]
+
+async def test_export_sales_csv(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    db_session.add(Sale(product_id=product.id, quantity=2, total_price=200.0, user_id=user.id, date_sold=datetime(2025, 1, 1)))
+    await db_session.commit()
+    response = await client.get("/export/sales", params={"format": "csv"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.strip().splitlines()
+    assert lines[0] == "id,date_sold,product_id,product_name,quantity,total_price"
+    assert lines[1].endswith(f",{product.id},Test Product,2,200.0")
+
+async def test_export_stocks_ndjson(stocked_product):
+    client, user, product, stock = stocked_product
+    response = await client.get("/export/stocks", params={"format": "ndjson"})
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows == [{"id": stock.id, "product_id": product.id, "product_name": "Test Product", "quantity": 20, "minimum_quantity": 10}]
+
+async def test_report_aggregates(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    db_session.add_all([
+        Sale(product_id=product.id, quantity=2, total_price=200.0, user_id=user.id, date_sold=datetime(2025, 1, 1)),
+        Sale(product_id=product.id, quantity=3, total_price=300.0, user_id=user.id, date_sold=datetime(2025, 1, 2))
+    ])
+    await db_session.commit()
+    await rebuild_user_rollups(db_session, [user.id])
+    await db_session.commit()
+    response = await client.get("/report", params={"date_from": "2025-01-01", "date_to": "2025-01-02", "limit": 1})
+    assert response.status_code == 200
+    assert "Общая сумма продаж: 500.0" in response.text
+    assert "Продано единиц: 5" in response.text
+    assert "2025-01-01" in response.text and "2025-01-02" in response.text
+    assert "cursor=" in response.text
+
+async def test_sale_writes_update_rollup(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    await client.post("/sales/create", data={"product_id": product.id, "quantity": 4})
+    sale = (await db_session.execute(select(Sale).filter(Sale.product_id == product.id))).scalar_one()
+    await client.post(f"/sales/edit/{sale.id}", data={"product_id": product.id, "quantity": 6})
+    rollup = (await db_session.execute(
+        select(SalesDailyRollup).filter(SalesDailyRollup.user_id == user.id).execution_options(populate_existing=True)
+    )).scalar_one()
+    assert (rollup.units, rollup.revenue) == (6, 600.0)
+    await client.get(f"/sales/delete/{sale.id}")
+    rollup = (await db_session.execute(
+        select(SalesDailyRollup).filter(SalesDailyRollup.user_id == user.id).execution_options(populate_existing=True)
+    )).scalar_one()
+    assert (rollup.units, rollup.revenue) == (0, 0.0)
+
+async def test_report_cache_invalidated_by_sale(stocked_product):
+    client, user, product, stock = stocked_product
+    response = await client.get("/report")
+    assert "Общая сумма продаж: 0" in response.text
+    hits = report_cache.stats()["hits"]
+    await client.get("/report")
+    assert report_cache.stats()["hits"] == hits + 1
+    await client.post("/sales/create", data={"product_id": product.id, "quantity": 2})
+    response = await client.get("/report")
+    assert "Общая сумма продаж: 200.0" in response.text
+
+def test_lru_cache_eviction_and_ttl():
+    cache = LRUCache(maxsize=2, ttl=None)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    expiring = LRUCache(maxsize=2, ttl=-1)
+    expiring.set("a", 1)
+    assert expiring.get("a") is None
+
+async def test_report_job_eager(stocked_product, db_session, monkeypatch, tmp_path):
+    client, user, product, stock = stocked_product
+    monkeypatch.setattr(celery_app.conf, "task_always_eager", True)
+    monkeypatch.setattr("backend.report_jobs.DATABASE_URL", TEST_DATABASE_URL)
+    monkeypatch.setattr("backend.report_jobs.REPORT_JOBS_DIR", str(tmp_path))
+    response = await client.post("/report/jobs")
+    assert response.status_code == 202
+    job = response.json()
+    assert job["status"] == "done"
+    response = await client.get(f"/report/jobs/{job['id']}")
+    assert response.json()["status"] == "done"
+    response = await client.get(job["files"]["stocks.csv"])
+    assert response.status_code == 200
+    assert response.text.splitlines()[1] == f"{stock.id},{product.id},Test Product,20,10"
+    response = await client.get(job["files"]["report.xlsx"])
+    assert response.status_code == 200
+
+async def test_stock_movements_ledger(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    await client.post("/sales/create", data={"product_id": product.id, "quantity": 5})
+    sale = (await db_session.execute(select(Sale).filter(Sale.product_id == product.id))).scalar_one()
+    await client.post(f"/sales/edit/{sale.id}", data={"product_id": product.id, "quantity": 8})
+    await client.post("/stocks/create", data={"product_id": product.id, "quantity": 10})
+    response = await client.get(f"/stocks/movements/{product.id}")
+    movements = response.json()
+    assert [(m["kind"], m["quantity"], m["balance_after"]) for m in movements] == [
+        ("sale", -5, 15), ("reversal", 5, 20), ("sale", -8, 12), ("receipt", 10, 22)
+    ]
+    assert all(m["sale_id"] == sale.id for m in movements[:3])
+    response = await client.get(f"/stocks/balance/{product.id}")
+    assert response.json()["quantity"] == 22
+    removed = await compact_movements(db_session, datetime.utcnow() + timedelta(seconds=1))
+    await db_session.commit()
+    assert removed == 3
+    response = await client.get(f"/stocks/balance/{product.id}")
+    assert response.json()["quantity"] == 22
+
+async def test_compact_movements_over_many_products(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    # Товаров больше, чем asyncpg допускает параметров в одном запросе
+    params = {"user_id": user.id, "manufacturer_id": product.manufacturer_id, "counterparty_id": product.counterparty_id, "agreement_id": product.agreement_id}
+    await db_session.execute(text(
+        "INSERT INTO products (name, price, manufacturer_id, counterparty_id, agreement_id, user_id) "
+        "SELECT 'SKU ' || g, 1.0, :manufacturer_id, :counterparty_id, :agreement_id, :user_id FROM generate_series(1, 33000) g"
+    ), params)
+    await db_session.execute(text(
+        "INSERT INTO stock_movements (user_id, product_id, kind, quantity, balance_after, created_at) "
+        "SELECT :user_id, id, 'receipt', n, n * 10, now() - make_interval(days => 10 - n) "
+        "FROM products CROSS JOIN generate_series(1, 2) n WHERE user_id = :user_id"
+    ), {"user_id": user.id})
+    await db_session.commit()
+    removed = await compact_movements(db_session, datetime.utcnow() + timedelta(seconds=1))
+    await db_session.commit()
+    assert removed == 33001
+    rows = (await db_session.execute(
+        select(StockMovement.kind, StockMovement.balance_after, func.count()).group_by(StockMovement.kind, StockMovement.balance_after)
+    )).all()
+    assert rows == [("snapshot", 20, 33001)]
+
+async def test_low_stocks(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    response = await client.get("/stocks/low", params={"format": "json"})
+    assert response.json() == {"items": [], "next_after": None}
+    stock.minimum_quantity = 25
+    await db_session.commit()
+    response = await client.get("/stocks/low", params={"format": "json"})
+    assert response.json()["items"] == [
+        {"id": stock.id, "product_id": product.id, "product_name": "Test Product", "quantity": 20, "minimum_quantity": 25}
+    ]
+    response = await client.get("/stocks/low")
+    assert "text/html" in response.headers["content-type"]
+    assert "Test Product" in response.text
+
+async def test_get_stocks_lean_projection(stocked_product):
+    client, user, product, stock = stocked_product
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(test_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        response = await client.get("/stocks", params={"sort": "quantity", "order": "desc"})
+    finally:
+        event.remove(test_engine.sync_engine, "before_cursor_execute", record)
+    assert response.status_code == 200
+    assert "Test Product" in response.text
+    stock_statements = [s for s in statements if "FROM stock" in s]
+    assert len(stock_statements) == 1
+    select_list = stock_statements[0].split("FROM")[0]
+    assert select_list.count(",") == 3
+    assert "manufacturer" not in stock_statements[0]
+    assert "counterparty" not in stock_statements[0]
+
+async def test_add_stock_upserts_existing_row(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    product_id = product.id
+    response = await client.post("/stocks/create", data={"product_id": product_id, "quantity": 5})
+    assert response.status_code == 303
+    assert (await db_session.execute(select(Stock.quantity).filter(Stock.product_id == product_id))).scalars().all() == [25]
+    response = await client.post("/stocks/create", data={"product_id": 999999, "quantity": 5})
+    assert "Product not found" in response.text
+    for quantity in (0, -5):
+        response = await client.post("/stocks/create", data={"product_id": product_id, "quantity": quantity})
+        assert "Quantity must be positive" in response.text
+    db_session.expire_all()
+    assert (await db_session.execute(select(Stock.quantity).filter(Stock.product_id == product_id))).scalars().all() == [25]
+
+async def test_import_stock_csv(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    content = f"product_id,quantity\n{product.id},5\n999999,3\n{product.id},-1\n{product.id},7\n".encode()
+    response = await client.post("/stocks/import", files={"file": ("receipt.csv", content, "text/csv")})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["lines"] == 4
+    assert data["imported"] == 2
+    assert data["products_updated"] == 1
+    assert data["errors"] == [
+        {"line": 3, "error": "Product not found or you don't have permission"},
+        {"line": 4, "error": "Quantity must be positive"}
+    ]
+    updated_stock = await db_session.execute(select(Stock).filter(Stock.product_id == product.id))
+    assert updated_stock.scalar_one().quantity == 32
+
+async def test_reservation_blocks_sale_and_confirms(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    # Маршруты откатывают общую с тестом сессию, после этого атрибуты product истекают
+    product_id = product.id
+    response = await client.post("/reservations", json={"product_id": product_id, "quantity": 15})
+    assert response.status_code == 201
+    reservation_id = response.json()["id"]
+    response = await client.get(f"/reservations/available/{product_id}")
+    assert response.json()["available"] == 5
+    response = await client.post("/sales/create", data={"product_id": product_id, "quantity": 10})
+    assert "Not enough stock available" in response.text
+    response = await client.post(f"/reservations/{reservation_id}/confirm")
+    assert response.status_code == 200
+    assert response.json()["sale_id"] is not None
+    response = await client.post(f"/reservations/{reservation_id}/release")
+    assert response.status_code == 409
+    response = await client.get(f"/reservations/available/{product_id}")
+    assert response.json() == {"product_id": product_id, "quantity": 5, "reserved": 0, "available": 5}
+
+async def test_reservation_release_and_expire(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    product_id = product.id
+    first = (await client.post("/reservations", json={"product_id": product_id, "quantity": 5})).json()
+    await client.post("/reservations", json={"product_id": product_id, "quantity": 10, "ttl_seconds": 60})
+    response = await client.post("/reservations", json={"product_id": product_id, "quantity": 6})
+    assert response.status_code == 400
+    response = await client.post(f"/reservations/{first['id']}/release")
+    assert response.status_code == 200
+    assert await expire_batch(db_session, datetime.utcnow() + timedelta(hours=1), 100) == 1
+    await db_session.commit()
+    response = await client.get(f"/reservations/available/{product_id}")
+    assert response.json()["available"] == 20
+    statuses = (await db_session.execute(select(StockReservation.status).order_by(StockReservation.id))).scalars().all()
+    assert statuses == ["released", "expired"]
+
+async def test_reservation_ttl_validation(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    product_id = product.id
+    for ttl_seconds in (-60, 0, 10 ** 9):
+        response = await client.post("/reservations", json={"product_id": product_id, "quantity": 1, "ttl_seconds": ttl_seconds})
+        assert response.status_code == 422
+    response = await client.get(f"/reservations/available/{product_id}")
+    assert response.json()["reserved"] == 0
+    response = await client.post("/reservations", json={"product_id": product_id, "quantity": 1, "ttl_seconds": 30})
+    assert response.status_code == 201
+    expires_at = datetime.fromisoformat(response.json()["expires_at"])
+    assert timedelta(seconds=0) < expires_at - datetime.utcnow() <= timedelta(seconds=30)
+
+def test_compute_suggestions():
+    series = np.array([[1, 2, 3, 4, 5, 6], [0, 0, 0, 0, 0, 0]], dtype=np.float32)
+    result = compute_suggestions(series, np.array([10, 5]), window=3, lead_time_days=2, review_days=1, service_z=1.0)
+    assert result["avg_daily_demand"].tolist() == [5.0, 0.0]
+    assert result["demand_std"].tolist() == [2.0, 0.0]
+    assert result["reorder_point"].tolist() == [13, 0]
+    assert result["order_quantity"].tolist() == [8, 0]
+    assert result["days_of_cover"][0] == 2.0 and np.isnan(result["days_of_cover"][1])
+
+async def test_forecast_writes_suggestions_for_stocks_page(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    today = datetime(2025, 3, 1).date()
+    db_session.add_all([
+        SalesDailyRollup(user_id=user.id, product_id=product.id, day=today - timedelta(days=day), units=4, revenue=400.0)
+        for day in range(1, 61)
+    ])
+    await db_session.commit()
+    assert await forecast_user(db_session, user.id, today, history_days=90) == 1
+    await db_session.commit()
+    suggestion = (await db_session.execute(select(ReorderSuggestion))).scalar_one()
+    assert suggestion.avg_daily_demand == 4.0
+    assert suggestion.days_of_cover == 5.0
+    assert suggestion.reorder_point > 0
+    response = await client.get("/stocks")
+    assert str(suggestion.order_quantity) in response.text
+
+async def test_stock_changes_published_after_commit(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    queue = stock_events.subscribe(user.id)
+    try:
+        await client.post("/sales/create", data={"product_id": product.id, "quantity": 5})
+        assert queue.get_nowait() == [{"id": stock.id, "quantity": 15, "minimum_quantity": stock.minimum_quantity}]
+        await client.get(f"/stocks/delete/{stock.id}")
+        assert queue.get_nowait() == [{"id": stock.id, "deleted": True}]
+        assert queue.empty()
+    finally:
+        stock_events.unsubscribe(user.id, queue)
+
+async def test_slow_subscriber_gets_resync():
+    events = LocalStockEvents(queue_size=2)
+    slow, other = events.subscribe(1), events.subscribe(2)
+    for quantity in range(3):
+        await events.publish(1, [{"id": 1, "quantity": quantity}])
+    assert slow.get_nowait() is None
+    assert slow.empty() and other.empty()
+    assert events.stats() == {"subscribers": 2, "published": 3, "dropped": 1}
+
+async def test_product_search_api(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    db_session.add_all([
+        Product(name=name, price=1.0, manufacturer_id=product.manufacturer_id, counterparty_id=product.counterparty_id,
+                agreement_id=product.agreement_id, user_id=user.id)
+        for name in ["Bolt M6", "bolt M8", "Nut M6", "100% cotton"]
+    ])
+    await db_session.commit()
+    response = await client.get("/product/api/search", params={"q": "bo", "limit": 1})
+    data = response.json()
+    assert [item["name"] for item in data["items"]] == ["Bolt M6"]
+    response = await client.get("/product/api/search", params={"q": "bo", "limit": 1, "cursor": data["next_cursor"]})
+    assert [item["name"] for item in response.json()["items"]] == ["bolt M8"]
+    assert response.json()["next_cursor"] is None
+    response = await client.get("/product/api/search", params={"q": "t m6"})
+    assert [item["name"] for item in response.json()["items"]] == ["Bolt M6", "Nut M6"]
+    response = await client.get("/product/api/search", params={"q": "0% c"})
+    assert [item["name"] for item in response.json()["items"]] == ["100% cotton"]
+    response = await client.get("/sales/create")
+    assert "Test Product" not in response.text
+
+async def test_reference_cache_for_product_form(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    reference_cache.clear()
+    await client.get("/product/create")
+    hits = reference_cache.stats()["hits"]
+    response = await client.get("/product/create")
+    assert "Test Man" in response.text
+    assert reference_cache.stats()["hits"] == hits + 3
+    await client.post("/manufacturer/create", data={"name": "New Man", "address": "1 St", "manager": "M", "phone_number": "1"})
+    response = await client.get("/product/create")
+    assert "New Man" in response.text
+    assert reference_cache.stats()["hits"] == hits + 5
+
+async def test_product_edit_checks_ownership_in_one_query(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    other = User(username="other", email="other@example.com", hashed_password="-")
+    db_session.add(other)
+    await db_session.commit()
+    foreign = Manufacturer(name="Foreign Man", address="1 St", phone_number="1", user_id=other.id)
+    db_session.add(foreign)
+    await db_session.commit()
+    # После отката в маршруте атрибуты product истекают, поэтому ссылки берём заранее
+    product_id, manufacturer_id, foreign_id = product.id, product.manufacturer_id, foreign.id
+    form = {"name": "Renamed", "price": 5.0, "counterparty_id": product.counterparty_id, "agreement_id": product.agreement_id}
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(test_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        response = await client.post(f"/product/edit/{product_id}", data={**form, "manufacturer_id": foreign_id})
+    finally:
+        event.remove(test_engine.sync_engine, "before_cursor_execute", record)
+    # Jinja экранирует апостроф, поэтому сверяем часть сообщения без него
+    assert "permission to use this manufacturer" in response.text
+    assert len([s for s in statements if s.lstrip().startswith("SELECT")]) == 1
+    response = await client.post(f"/product/edit/{product_id}", data={**form, "manufacturer_id": manufacturer_id})
+    assert response.status_code == 303
+    response = await client.post("/product/edit/999999", data={**form, "manufacturer_id": manufacturer_id})
+    assert "Product not found" in response.text
+
+async def test_import_product_catalogue(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    content = (
+        "name,price,manufacturer,counterparty,agreement\n"
+        "Test Product,150,Test Man,Test Counter,A1\n"
+        "New Product,20.5,Test Man,Test Counter,A1\n"
+        "Other Product,10,Unknown Man,Test Counter,A1\n"
+        "New Product,30,Test Man,Test Counter,A1\n"
+        "Bad Price,abc,Test Man,Test Counter,A1\n"
+    ).encode()
+    response = await client.post("/product/import", files={"file": ("catalogue.csv", content, "text/csv")})
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["lines"], data["inserted"], data["updated"], data["failed"]) == (5, 1, 1, 3)
+    assert data["errors"] == [
+        {"line": 4, "error": "Manufacturer not found or you don't have permission"},
+        {"line": 5, "error": "Duplicate product name in file"},
+        {"line": 6, "error": "Invalid price"}
+    ]
+    prices = dict((await db_session.execute(select(Product.name, Product.price).filter(Product.user_id == user.id))).all())
+    assert prices == {"Test Product": 150.0, "New Product": 20.5}
+
+async def test_product_price_history(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    refs = {"manufacturer_id": product.manufacturer_id, "counterparty_id": product.counterparty_id, "agreement_id": product.agreement_id}
+    await client.post("/product/create", data={"name": "Priced", "price": 10.0, **refs})
+    priced = (await db_session.execute(select(Product).filter(Product.name == "Priced"))).scalar_one()
+    before_change = datetime.utcnow()
+    await client.post(f"/product/edit/{priced.id}", data={"name": "Priced", "price": 12.0, **refs})
+    response = await client.get(f"/product/api/prices/{priced.id}", params={"at": before_change.isoformat()})
+    assert response.json()["price"] == 10.0
+    response = await client.get(f"/product/api/prices/{priced.id}")
+    assert response.json()["price"] == 12.0
+    response = await client.get(f"/product/api/prices/{priced.id}", params={"at": "2000-01-01"})
+    assert response.status_code == 404
+    response = await client.get("/product/api/prices", params={"product_id": [priced.id, product.id], "at": before_change.isoformat()})
+    assert [item["price"] for item in response.json()["prices"]] == [10.0, None]
+
+async def test_current_user_cached_between_requests(authenticated_client, db_session):
+    client, user = authenticated_client
+    await client.get("/stocks")
+    hits = user_cache.stats()["hits"]
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(test_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        response = await client.get("/stocks")
+    finally:
+        event.remove(test_engine.sync_engine, "before_cursor_execute", record)
+    assert response.status_code == 200
+    assert user_cache.stats()["hits"] == hits + 1
+    assert not [s for s in statements if "FROM users" in s]
+    user.email = "changed@example.com"
+    await db_session.commit()
+    assert user_cache.get("testuser") is None
+
+async def test_login_rehashes_password_with_current_cost(client, db_session):
+    user = User(username="testuser", email="test@example.com", hashed_password=bcrypt.using(rounds=4).hash("testpass"))
+    db_session.add(user)
+    await db_session.commit()
+    old_hash = user.hashed_password
+    response = await client.post("/login", data={"username": "testuser", "password": "testpass"}, follow_redirects=False)
+    assert response.status_code == 303
+    assert user.hashed_password != old_hash
+    assert not pwd_context.needs_update(user.hashed_password)
+    assert pwd_context.verify("testpass", user.hashed_password)
+
+async def test_login_throttled_per_username_before_hashing(client, db_session, monkeypatch):
+    user = User(username="testuser", email="test@example.com", hashed_password=hash_password("testpass"))
+    db_session.add(user)
+    await db_session.commit()
+    throttle = LoginThrottle(MemoryTokenBuckets(100))
+    throttle.limits["username"] = (2, 1 / 60)
+    monkeypatch.setattr("backend.auth.login_throttle", throttle)
+    for _ in range(2):
+        response = await client.post("/login", data={"username": "TestUser", "password": "wrong"}, follow_redirects=False)
+        assert response.headers["location"] == "/login?error=1"
+    response = await client.post("/login", data={"username": "testuser", "password": "testpass"}, follow_redirects=False)
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) > 0
+    assert throttle.stats() == {"rejected_ip": 0, "rejected_username": 1}
+
+async def test_admin_pool_stats(authenticated_client, monkeypatch):
+    client, user = authenticated_client
+    response = await client.get("/admin/pool")
+    assert response.status_code == 403
+    monkeypatch.setattr("routes.admin.ADMIN_USERNAMES", {"testuser"})
+    response = await client.get("/admin/pool")
+    assert response.status_code == 200
+    stats = response.json()
+    assert {"pool_size", "checked_out", "overflow", "checkouts", "timeouts", "wait_avg_ms", "wait_max_ms"} <= set(stats)
+
+async def test_create_sale_decrements_stock_atomically(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    product_id, stock_id = product.id, stock.id
+    response = await client.post("/sales/create", data={"product_id": product_id, "quantity": 15}, follow_redirects=False)
+    assert response.status_code == 303
+    response = await client.post("/sales/create", data={"product_id": product_id, "quantity": 6}, follow_redirects=False)
+    assert response.status_code == 400
+    assert "Not enough stock available" in response.text
+    response = await client.post("/sales/create", data={"product_id": product_id, "quantity": -5}, follow_redirects=False)
+    assert response.status_code == 400
+    assert "Quantity must be positive" in response.text
+    db_session.expire_all()
+    assert (await db_session.execute(select(Stock.quantity).filter(Stock.id == stock_id))).scalar_one() == 5
+    sales = (await db_session.execute(select(Sale.quantity).filter(Sale.product_id == product_id))).scalars().all()
+    assert sales == [15]
+
+async def test_delete_product_with_history(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    product_id, stock_id = product.id, stock.id
+    response = await client.post("/sales/create", data={"product_id": product_id, "quantity": 5}, follow_redirects=False)
+    assert response.status_code == 303
+    sale_id = (await db_session.execute(select(Sale.id).filter(Sale.product_id == product_id))).scalar_one()
+    await client.get(f"/sales/delete/{sale_id}", follow_redirects=False)
+    await client.get(f"/stocks/delete/{stock_id}", follow_redirects=False)
+    response = await client.get(f"/product/delete/{product_id}", follow_redirects=False)
+    assert response.status_code == 303
+    db_session.expire_all()
+    assert (await db_session.execute(select(Product).filter(Product.id == product_id))).scalar_one_or_none() is None
+    assert (await db_session.execute(select(StockMovement).filter(StockMovement.product_id == product_id))).first() is None
+    assert (await db_session.execute(select(SalesDailyRollup).filter(SalesDailyRollup.product_id == product_id))).first() is None
+
+async def test_stock_edit_and_delete_respect_reservations(stocked_product, db_session):
+    client, user, product, stock = stocked_product
+    product_id, stock_id = product.id, stock.id
+    other = Product(name="Other Product", price=1.0, manufacturer_id=product.manufacturer_id, counterparty_id=product.counterparty_id, agreement_id=product.agreement_id, user_id=user.id)
+    db_session.add(other)
+    await db_session.commit()
+    other_id = other.id
+    reservation_id = (await client.post("/reservations", json={"product_id": product_id, "quantity": 12})).json()["id"]
+    response = await client.post(f"/stocks/edit/{stock_id}", data={"product_id": product_id, "quantity": 8}, follow_redirects=False)
+    assert "Quantity cannot be less than reserved (12)" in response.text
+    response = await client.post(f"/stocks/edit/{stock_id}", data={"product_id": other_id, "quantity": 20}, follow_redirects=False)
+    assert "the product cannot be changed" in response.text
+    response = await client.get(f"/stocks/delete/{stock_id}", follow_redirects=False)
+    assert "cannot be deleted" in response.text
+    response = await client.post(f"/stocks/edit/{stock_id}", data={"product_id": product_id, "quantity": 12}, follow_redirects=False)
+    assert response.status_code == 303
+    response = await client.get(f"/reservations/available/{product_id}")
+    assert response.json()["available"] == 0
+    await client.post(f"/reservations/{reservation_id}/release")
+    response = await client.get(f"/stocks/delete/{stock_id}", follow_redirects=False)
+    assert response.status_code == 303
+
+async def test_admin_throttle_stats(authenticated_client, monkeypatch):
+    client, user = authenticated_client
+    throttle = LoginThrottle(MemoryTokenBuckets(100))
+    throttle.limits["ip"] = (1, 1 / 60)
+    monkeypatch.setattr("backend.auth.login_throttle", throttle)
+    monkeypatch.setattr("routes.admin.login_throttle", throttle)
+    response = await client.get("/admin/throttle")
+    assert response.status_code == 403
+    monkeypatch.setattr("routes.admin.ADMIN_USERNAMES", {"testuser"})
+    for _ in range(2):
+        await client.post("/login", data={"username": "nobody", "password": "wrong"}, follow_redirects=False)
+    response = await client.get("/admin/throttle")
+    assert response.status_code == 200
+    assert response.json() == {"rejected_ip": 1, "rejected_username": 0}
+
+async def test_admin_cache_stats(authenticated_client, monkeypatch):
+    client, user = authenticated_client
+    response = await client.get("/admin/cache")
+    assert response.status_code == 403
+    monkeypatch.setattr("routes.admin.ADMIN_USERNAMES", {"testuser"})
+    hits = user_cache.stats()["hits"]
+    await client.get("/admin/cache")
+    response = await client.get("/admin/cache")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["users"]["hits"] > hits
+    assert {"hits", "misses", "hit_rate"} <= set(stats["reference"]) and {"hits", "misses", "hit_rate"} <= set(stats["report"])